@@ -18,9 +18,28 @@ import argparse as ap
 import csv
 import multiprocessing as mp
 import os
+import queue
+import sys
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 
+# the shared helpers live in phredlib.py at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from phredlib import (CACHE_DIR, ResultCache, align_to_record, bgzf_blocks, chunck_metrics, decode_qualities,
+                      decode_windows, detect_compression, fingerprint, inflate_bgzf, last_record_end,
+                      load_checkpoint, load_index, map_chunck, measure, metrics_record, store_checkpoint,
+                      stream_gzip, timings_line, write_metrics)
+
+# base positions per file and worker kept in shared memory by the --shared backend
+SHARED_CAPACITY = 1024
+WORKER_TOTALS = None
+WORKER_ROW = None
+# (metrics file, FastQ file per job number) of a pool worker when --metrics is used
+WORKER_METRICS = None
+
 
 def parse_arguments():
     """
@@ -29,6 +48,18 @@ def parse_arguments():
     args:
         -n: amount of cores to use
         -o: specify name and location of csv output file to be written to
+        --totals: keep per-position sums and counts instead of every score
+        --index: split on record count using a .fqi index
+        --index-interval: amount of records between two offsets in the .fqi index
+        --chunks-per-core: amount of chuncks per core, for dynamic load balancing
+        --chunk-size: target chunck size in MB, overrides --chunks-per-core
+        --shared: reduce the results through shared memory, one row per worker
+        --metrics: append per-chunck measurements as JSON lines to this file
+        --cache: reuse the sums and counts of files that were processed before
+        --cache-dir: directory of the result cache
+        --cache-size: size limit of the result cache in MB
+        --incremental: only process what was appended since the checkpoint of the last run
+        --timings: print the time spent per phase as a [Timings] line at the end
         fastq_files: FastQ files to be processed. User can add multiple at once.
     """
     argparser = ap.ArgumentParser(description="Script voor Opdracht 1 van Big Data Computing")
@@ -37,6 +68,31 @@ def parse_arguments():
                        help="Aantal cores om te gebruiken.")
     argparser.add_argument("-o", action="store", dest="csvfile", type=ap.FileType('w', encoding='UTF-8'),
                        required=False, help="CSV file om de output in op te slaan. Default is output naar terminal STDOUT")
+    argparser.add_argument("--totals", action="store_true", required=False,
+                       help="Houd per positie alleen de som en het aantal scores bij; geheugen hangt dan af van de leeslengte.")
+    argparser.add_argument("--index", action="store_true", required=False,
+                       help="Verdeel op aantal records met een .fqi index van elk --index-interval-de record.")
+    argparser.add_argument("--index-interval", action="store", dest="index_interval", type=int, default=1000,
+                       required=False, help="Aantal records tussen twee offsets in de .fqi index (default 1000).")
+    argparser.add_argument("--chunks-per-core", action="store", dest="chuncks_per_core", type=int, default=1,
+                       required=False, help="Aantal chunks per core; meer kleine chunks verdelen het werk beter.")
+    argparser.add_argument("--chunk-size", action="store", dest="chunck_size", type=int, required=False,
+                       help="Doelgrootte van een chunk in MB; gaat voor --chunks-per-core.")
+    argparser.add_argument("--shared", action="store_true", required=False,
+                       help="Workers tellen sommen en aantallen op in gedeeld geheugen in plaats van resultaten terug te sturen.")
+    argparser.add_argument("--metrics", action="store", required=False,
+                       help="Schrijf metingen per chunk als JSON lines naar dit bestand.")
+    argparser.add_argument("--cache", action="store_true", required=False,
+                       help="Hergebruik de sommen en aantallen van bestanden die al eens verwerkt zijn (impliceert --totals).")
+    argparser.add_argument("--cache-dir", action="store", dest="cache_dir", default=CACHE_DIR, required=False,
+                       help=f"Map van de cache (default {CACHE_DIR}, of $BDC_CACHE).")
+    argparser.add_argument("--cache-size", action="store", dest="cache_size", type=int, default=64, required=False,
+                       help="Maximale grootte van de cache in MB; de langst niet gebruikte bestanden gaan eruit.")
+    argparser.add_argument("--incremental", action="store_true", required=False,
+                       help="Verwerk alleen wat sinds de vorige run aan een groeiend bestand is toegevoegd, "
+                            "met een checkpoint naast het bestand (impliceert --totals).")
+    argparser.add_argument("--timings", action="store_true", required=False,
+                       help="Print aan het eind de tijd per fase (read, parse, reduce, write) als [Timings] regel.")
     argparser.add_argument("fastq_files", action="store", type=ap.FileType('r'), nargs='+', help="Minstens 1 Illumina Fastq Format file om te verwerken")
     return argparser.parse_args()
 
@@ -46,32 +102,58 @@ class PhredScoreCalculator:
     Class used to handle the processing of a FastQ file to Phred scores.
 
     Functions:
-    - make_chuncks: splits FastQ file into chuncks in bytes based on the amount of cores
+    - make_chuncks: splits FastQ file into record-aligned chuncks based on the amount of cores
     - get_chuncks: simply retrieve all chuncks
     - process_file: this function calculates the Phred score per base position per chunck
     - calculate_average: calculates the average Phred score per base position by concatenating
                          all chuncks into defaultdict
+    - merge_totals: adds the per-position sums and counts of all chuncks together
+    - fold: adds the result of one chunck to a running aggregate
     - write_csv: used for writing the results to a CSV format
     """
 
-    def __init__(self, fastq, n):
+    def __init__(self, fastq, n, *, totals=False, index_interval=None, chuncks_per_core=1, chunck_size=None,
+                 span=None):
         """
         Initiator. 
 
         args:
         - fastq: FastQ file to be processed
         - n: amount of cores
+        - totals: when True, every chunck is memory-mapped and decoded by the vectorized
+                  decode_qualities kernel, and returns fixed-size per-position sums and
+                  counts instead of a list of every single score. Always on for
+                  gzip/BGZF compressed files
+        - index_interval: when given, split on record count using a .fqi sidecar
+                          holding the offset of every index_interval-th record
+        - chuncks_per_core: amount of chuncks to make per core; more, smaller chuncks
+                            balance the load when some chuncks are slower than others
+        - chunck_size: target size of a chunck in bytes, overrides chuncks_per_core
+        - span: (start, end) byte range of whole records to split instead of the whole
+                file, for --incremental; only used for uncompressed files, and goes
+                before the .fqi index, which would have to be rebuilt on every run
 
         self.chuncks: holds the chuncks defined by the make_chuncks function
         """
         self.fastq = fastq.name
         self.n = n
+        self.compression = detect_compression(self.fastq)
+        self.totals = totals or self.compression is not None
+        self.index_interval = index_interval
+        self.chuncks_per_core = chuncks_per_core
+        self.chunck_size = chunck_size
+        self.span = span
         self.chuncks = []
 
     def make_chuncks(self):
         """
         Determines how large a chunck is by calculating its start and end positions in bytes.
-        The amount of chuncks is equal to the number of cores given by the user.
+        The amount of chuncks is the number of cores given by the user times chuncks_per_core,
+        or follows from the target chunck_size.
+        Every split point is snapped to the start of a record, or taken from the .fqi index
+        so every chunck holds the same amount of records. BGZF files are split on block
+        boundaries in compressed bytes, plain gzip files can only be one chunck.
+        With a span, only that range of an uncompressed file is split, on record starts.
         All start and end positions are appended to self.chuncks for easy access within the class.
         """
         try:
@@ -79,11 +161,32 @@ class PhredScoreCalculator:
         except FileNotFoundError as err:
             print(f"{err}: File in question has not been found. Are you sure it exists?")
 
-        chunck_size = file_size // self.n
+        start, end = self.span if self.span and not self.compression else (0, file_size)
+        if self.chunck_size:
+            amount = max(1, -(-(end - start) // self.chunck_size))
+        else:
+            amount = self.n * self.chuncks_per_core
+        chunck_size = (end - start) // amount
+
+        if self.compression == "bgzf":
+            blocks = bgzf_blocks(self.fastq)
+            starts = np.searchsorted(blocks, np.arange(amount) * chunck_size)
+            bounds = [int(bound) for bound in np.append(blocks, file_size)[starts]]
+        elif self.compression == "gzip":
+            bounds = [0]
+        elif self.span:
+            with open(self.fastq, 'rb') as inputfile:
+                bounds = [start] + [min(align_to_record(inputfile, start + i * chunck_size), end)
+                                    for i in range(1, amount)]
+        elif self.index_interval:
+            offsets = load_index(self.fastq, self.index_interval)
+            bounds = [int(offsets[(i * len(offsets)) // amount]) for i in range(amount)]
+        else:
+            with open(self.fastq, 'rb') as inputfile:
+                bounds = [align_to_record(inputfile, i * chunck_size) for i in range(amount)]
+        bounds.append(end)
 
-        for i in range(self.n):
-            start = i * chunck_size
-            end = start + chunck_size if i < self.n - 1 else file_size
+        for start, end in zip(bounds, bounds[1:]):
             self.chuncks.append((start, end))
 
 
@@ -104,10 +207,20 @@ class PhredScoreCalculator:
         - chunck: chunck to be processed
 
         returns:
-        - phred_scores: defaultdict with Phred score per base position for said chunck
+        - phred_scores: defaultdict with Phred score per base position for said chunck,
+                        or a (sums, counts) tuple of int64 arrays in totals mode
         """
         # unpack the chunck's start and end positions
         start, end = chunck
+
+        if self.compression == "bgzf":
+            return decode_windows(inflate_bgzf(self.fastq, start, end))
+        if self.compression == "gzip":
+            return self.merge_totals([decode_qualities(piece) for piece in stream_gzip(self.fastq)])
+        if self.totals:
+            # chuncks are record-aligned, so the mapped range is decoded window by window
+            return decode_windows(map_chunck(self.fastq, start, end))
+
         # defaultdict makes adding more base positions more flexible
         phred_scores = defaultdict(list)
 
@@ -135,6 +248,10 @@ class PhredScoreCalculator:
         returns:
         - a defaultdict with the average phred score per base position
         """
+        if self.totals:
+            sums, counts = self.merge_totals(phred_scores)
+            return {pos: sums[pos] / counts[pos] for pos in range(len(sums)) if counts[pos]}
+
         combined = defaultdict(list)
 
         # combine every chunck into one dict
@@ -145,6 +262,48 @@ class PhredScoreCalculator:
         # then simply return the mean per base position
         return {key: np.mean(values) for key, values in combined.items()}
 
+    def merge_totals(self, totals):
+        """
+        Adds the per-position sums and counts of every chunck together. Chuncks
+        can hold reads of different lengths, so shorter arrays are padded first.
+
+        args:
+        - totals: list of (sums, counts) tuples
+
+        returns:
+        - one (sums, counts) tuple sized to the longest read
+        """
+        length = max((len(sums) for sums, _ in totals), default=0)
+        sums = np.zeros(length, dtype=np.int64)
+        counts = np.zeros(length, dtype=np.int64)
+
+        for sub_sums, sub_counts in totals:
+            sums[:len(sub_sums)] += sub_sums
+            counts[:len(sub_counts)] += sub_counts
+
+        return sums, counts
+
+    def fold(self, aggregate, result):
+        """
+        Adds the result of one chunck to a running aggregate, so results can be
+        merged while other chuncks are still being processed.
+
+        args:
+        - aggregate: result of all chuncks folded so far, or None
+        - result: result of a single chunck
+
+        returns:
+        - the new aggregate
+        """
+        if aggregate is None:
+            return result
+        if self.totals:
+            return self.merge_totals([aggregate, result])
+
+        for key, value in result.items():
+            aggregate[key].extend(value)
+        return aggregate
+
     
     def csv_writer(self, phred_scores, *, outputfile="output.csv", multiple=False):
         """
@@ -160,37 +319,331 @@ class PhredScoreCalculator:
         - average phred score per base position in CSV format
         """
         filename = os.path.basename(self.fastq) # get name of fastq file
-        name_output = outputfile if not multiple else f"{filename}.{outputfile}.csv"
-        with open(name_output.name, 'w', newline='', encoding='UTF-8') as csv_file:
+        directory, name = os.path.split(outputfile.name)
+        name_output = outputfile.name if not multiple else os.path.join(directory, f"{filename}.{name}")
+        with open(name_output, 'w', newline='', encoding='UTF-8') as csv_file:
             writer = csv.writer(csv_file)
             for key, value in phred_scores.items():
                 writer.writerow([key, value])
  
 
+class SharedTotals:
+    """
+    Per-position sums and counts in shared memory, with one row per pool worker
+    for every FastQ file. Every worker only adds to its own row, so no locks are
+    needed, and the parent reduces the rows of a file with one vectorized sum.
+    Positions beyond the capacity are rare and are handed back to the parent.
+
+    Functions:
+    - add: adds the sums and counts of one chunck to the row of a worker
+    - reduce: sums all worker rows of a file
+    - close: detaches from the shared memory, and removes it in the parent
+    """
+
+    def __init__(self, files, workers, capacity=SHARED_CAPACITY, name=None):
+        """
+        Initiator. Creates the shared memory, or attaches to it when a name is given.
+
+        args:
+        - files: amount of FastQ files
+        - workers: amount of pool workers
+        - capacity: amount of base positions kept in shared memory
+        - name: name of existing shared memory to attach to
+        """
+        self.shape = (files, workers, 2, capacity)
+        self.owner = name is None
+        size = int(np.prod(self.shape)) * np.dtype(np.int64).itemsize
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=max(size, 1))
+        self.rows = np.ndarray(self.shape, dtype=np.int64, buffer=self.memory.buf)
+        if self.owner:
+            self.rows[:] = 0
+
+    def add(self, number, row, sums, counts):
+        """
+        Adds the sums and counts of one chunck to the row of a worker.
+
+        returns:
+        - (sums, counts) of the positions that do not fit in shared memory
+        """
+        capacity = self.shape[-1]
+        self.rows[number, row, 0, :min(len(sums), capacity)] += sums[:capacity]
+        self.rows[number, row, 1, :min(len(counts), capacity)] += counts[:capacity]
+        return sums[capacity:], counts[capacity:]
+
+    def reduce(self, number):
+        """
+        Sums the rows of every worker for one file.
+
+        returns:
+        - (sums, counts) of the positions kept in shared memory
+        """
+        sums, counts = self.rows[number].sum(axis=0)
+        return sums, counts
+
+    def close(self):
+        """
+        Detaches from the shared memory; the parent also removes it.
+        """
+        del self.rows
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def init_worker(metrics):
+    """
+    Pool initializer: keeps the --metrics file and the FastQ file of every job number.
+    """
+    global WORKER_METRICS
+    WORKER_METRICS = metrics
+
+
+def init_shared_worker(name, shape, counter, metrics=None):
+    """
+    Pool initializer: attaches a worker to the shared totals and claims a row.
+    There is one row per worker of the pool. The pool never replaces a worker: when
+    one dies the pool breaks and main stops the run, so no worker is left without a row.
+    """
+    global WORKER_TOTALS, WORKER_ROW
+    init_worker(metrics)
+    files, workers, _, capacity = shape
+    WORKER_TOTALS = SharedTotals(files, workers, capacity, name=name)
+    with counter.get_lock():
+        WORKER_ROW = counter.value
+        counter.value += 1
+
+
+def run_shared_job(job):
+    """
+    Runs a single job inside a pool worker and adds its sums and counts to the
+    row of this worker in shared memory instead of sending them back.
+
+    returns:
+    - (file number, positions beyond the shared capacity)
+    """
+    number = job[0]
+    sums, counts = run_job(job)[1]
+    return number, WORKER_TOTALS.add(number, WORKER_ROW, sums, counts)
+
+
+def make_jobs(calculators, produced, producing, metrics=None, phases=None):
+    """
+    Generates the jobs of every FastQ file for one shared pool. Chuncks of all
+    files go through this single queue, so cores never sit idle between files.
+    Plain gzip files are streamed as record-aligned pieces.
+
+    args:
+    - calculators: one PhredScoreCalculator per FastQ file
+    - produced: list with the amount of jobs handed out per file, updated in place
+    - producing: set of file numbers that still hand out jobs, updated in place;
+                 files that are not in it to begin with are skipped
+    - metrics: file to append a measurement of every make_chuncks call to
+    - phases: dict to add the time spent in make_chuncks to, under read
+
+    yields:
+    - (file number, function, argument) tuples
+    """
+    for number, calculator in enumerate(calculators):
+        if number not in producing:
+            continue
+        if calculator.compression == "gzip":
+            work = ((decode_qualities, piece) for piece in stream_gzip(calculator.fastq))
+        else:
+            _, timings = measure(calculator.make_chuncks)
+            if phases is not None:
+                phases["read"] += timings["wall_seconds"]
+            if metrics:
+                write_metrics(metrics, [metrics_record("split", "pool", calculator.fastq, **timings,
+                                                       chuncks=len(calculator.get_chunks()))])
+            work = ((calculator.process_file, chunck) for chunck in calculator.get_chunks())
+
+        for function, argument in work:
+            produced[number] += 1
+            yield number, function, argument
+        producing.discard(number)
+
+
+def run_job(job):
+    """
+    Runs a single job inside a pool worker.
+
+    returns:
+    - (file number, result) so the result can be routed back to its file
+    """
+    number, function, argument = job
+    if WORKER_METRICS is None:
+        return number, function(argument)
+
+    path, files = WORKER_METRICS
+    result, timings = measure(function, argument)
+    write_metrics(path, [metrics_record("chunck", "pool", files[number], **timings,
+                                        **chunck_metrics(argument, result))])
+    return number, result
+
+
+def write_averages(calculator, aggregate, csvfile, multiple, metrics=None):
+    """
+    Calculates the averages of one FastQ file from its folded aggregate and writes
+    them to a CSV file, or prints them to the terminal when no CSV file is given.
+    """
+    averages, timings = measure(calculator.calculate_average, [] if aggregate is None else [aggregate])
+    if metrics:
+        write_metrics(metrics, [metrics_record("average", "pool", calculator.fastq, **timings,
+                                               positions=len(averages))])
+    if csvfile:
+        calculator.csv_writer(averages, outputfile=csvfile, multiple=multiple)
+    else:
+        for key, value in averages.items():
+            print(f"{key}, {value}")
+
+
 def main():
     """
     Main function of the script. Is responsible for defining the multiprocessing pool,
     using the class and its functions to guide the process of processing FASTQ files to calculate 
     and output phred quality score averages.
 
+    One pool lives for the whole run and handles the chuncks of every file. Results are
+    routed back to their file, and a file is written as soon as all its chuncks are done.
+    With --shared the workers add their sums and counts to shared memory instead.
+    When a worker dies, the pool breaks and the run stops with BrokenProcessPool
+    instead of waiting for results that never come.
+    With --cache, files found in the result cache are written right away and never read;
+    the pool is only started when at least one file is missing.
+    With --incremental, only the complete records after the checkpoint of an uncompressed
+    file are split and processed; their totals are added to those of the checkpoint,
+    which then moves to the end of the last complete record.
+    With --timings, the run is split into read (setting up and splitting the files),
+    parse (the pool at work), reduce (folding the results in) and write.
+
     Output:
         - if csvfile is asked, write the results to an output csv file
         - otherwise, simply print the results to the console
     """
+    started = time.perf_counter()
+    phases = dict.fromkeys(("read", "parse", "reduce", "write"), 0.0)
     args = parse_arguments()
-
-    for file in args.fastq_files:
-        calculator = PhredScoreCalculator(file, args.n)
-        calculator.make_chuncks()
-        with mp.Pool(args.n) as pool:
-            results = pool.map(calculator.process_file, calculator.get_chunks())
-        averages = calculator.calculate_average(results)
-        if args.csvfile:
-            multiple = len(args.fastq_files)>1 # check for naming output files
-            calculator.csv_writer(averages, outputfile=args.csvfile, multiple=multiple)
-        else:
-            for key, value in averages.items():
-                print(f"{key}, {value}")
+    multiple = len(args.fastq_files) > 1 # check for naming output files
+
+    def write(calculator, aggregate):
+        before = time.perf_counter()
+        write_averages(calculator, aggregate, args.csvfile, multiple, args.metrics)
+        phases["write"] += time.perf_counter() - before
+
+    def report():
+        if args.timings:
+            total = time.perf_counter() - started
+            # the pool reads memory-mapped chuncks while it decodes them, so that is parse time
+            parse = total - phases["read"] - phases["reduce"] - phases["write"]
+            print(timings_line(phases["read"], parse, phases["reduce"], phases["write"], total))
+
+    chunck_size = args.chunck_size * 1024 * 1024 if args.chunck_size else None
+    calculators = [PhredScoreCalculator(file, args.n, totals=args.totals or args.shared or args.cache or args.incremental,
+                                        index_interval=args.index_interval if args.index else None,
+                                        chuncks_per_core=args.chuncks_per_core, chunck_size=chunck_size)
+                   for file in args.fastq_files]
+    aggregates = [None] * len(calculators)
+    received = [0] * len(calculators)
+    produced = [0] * len(calculators)
+    producing = set(range(len(calculators)))
+    pending = set(range(len(calculators)))
+    metrics = (args.metrics, [calculator.fastq for calculator in calculators]) if args.metrics else None
+
+    cache = ResultCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+    # fingerprints are taken before processing, so a file that changes meanwhile is not cached as new
+    keys = [fingerprint(calculator.fastq) for calculator in calculators] if cache else None
+    checkpoints = [None] * len(calculators)
+    for number, calculator in enumerate(calculators):
+        if args.incremental and calculator.compression:
+            print(f"[Warning] {calculator.fastq} is compressed and is processed as a whole.")
+        elif args.incremental:
+            offset, checkpoints[number] = load_checkpoint(calculator.fastq)
+            calculator.span = (offset, last_record_end(calculator.fastq, offset))
+
+    for number, calculator in enumerate(calculators):
+        cached = cache.load(keys[number]) if cache else None
+        if cached is None and calculator.span and calculator.span[0] == calculator.span[1]:
+            # nothing was appended since the last run
+            cached = checkpoints[number]
+        if cached is not None:
+            write(calculator, cached)
+            producing.discard(number)
+            pending.discard(number)
+    if not pending:
+        phases["read"] = time.perf_counter() - started - phases["write"]
+        report()
+        return
+
+    if args.shared:
+        shared = SharedTotals(len(calculators), args.n)
+        pool = ProcessPoolExecutor(args.n, initializer=init_shared_worker,
+                                   initargs=(shared.memory.name, shared.shape, mp.Value('i', 0), metrics))
+        run = run_shared_job
+    else:
+        shared = None
+        pool = ProcessPoolExecutor(args.n, initializer=init_worker, initargs=(metrics,))
+        run = run_job
+    phases["read"] += time.perf_counter() - started - phases["write"]
+
+    def finish(number):
+        before = time.perf_counter()
+        aggregate = aggregates[number]
+        if shared:
+            # the shared rows hold every position up to the capacity, results only what is beyond
+            sums, counts = shared.reduce(number)
+            if aggregate is not None:
+                sums = np.concatenate((sums, aggregate[0]))
+                counts = np.concatenate((counts, aggregate[1]))
+            aggregate = (sums, counts)
+        calculator = calculators[number]
+        if checkpoints[number] is not None:
+            aggregate = calculator.merge_totals([checkpoints[number]] + ([aggregate] if aggregate is not None else []))
+        if calculator.span and aggregate is not None:
+            store_checkpoint(calculator.fastq, calculator.span[1], aggregate)
+        elif cache and aggregate is not None:
+            # a growing file would be cached without its last, half written record
+            cache.store(keys[number], aggregate)
+        phases["reduce"] += time.perf_counter() - before
+        write(calculator, aggregate)
+        aggregates[number] = None
+        pending.discard(number)
+
+    # futures come back through their callbacks in completion order
+    finished = queue.SimpleQueue()
+
+    def collect():
+        # raises the error of a failed job, or BrokenProcessPool when a worker died
+        number, result = finished.get().result()
+        before = time.perf_counter()
+        aggregates[number] = calculators[number].fold(aggregates[number], result)
+        phases["reduce"] += time.perf_counter() - before
+        received[number] += 1
+        for done in [i for i in pending if i not in producing and received[i] == produced[i]]:
+            finish(done)
+
+    try:
+        try:
+            # jobs are handed out from this thread and at most 2 * n are out at once, so
+            # a failing job stops the run instead of leaving the pool blocked on new jobs
+            outstanding = 0
+            for job in make_jobs(calculators, produced, producing, args.metrics, phases):
+                pool.submit(run, job).add_done_callback(finished.put)
+                outstanding += 1
+                if outstanding >= 2 * args.n:
+                    collect()
+                    outstanding -= 1
+            for _ in range(outstanding):
+                collect()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        # files without any jobs, or whose last job finished before all jobs were handed out
+        for done in sorted(pending):
+            finish(done)
+    finally:
+        if shared:
+            shared.close()
+    report()
 
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@ By Dennis Scheper (373689)
 
 Usage:
     Start server:
-        python3 assignment2.py -s rnaseqfile.fastq --host <een workstation> --port <een poort> --chunks <een getal>
+        python3 assignment2.py -s rnaseqfile.fastq --host <een workstation> --port <een poort> --chunks <een getal> [--window <een getal>]
     Start client:
         python3 assignment2.py -c --host <diezelfde host als voor server> --port <diezelfde poort als voor server> -n <aantal cpus in client computer>
 """
@@ -21,11 +21,29 @@ import os
 import time
 import queue
 import multiprocessing as mp
+from collections import deque
 from multiprocessing.managers import BaseManager
 import argparse as ap
+import numpy as np
 from phred import PhredScoreCalculator
+# importing phred puts phredlib, at the root of the repository, on sys.path
+from phredlib import (CACHE_DIR, ResultCache, chunck_metrics, decode_qualities, fingerprint, measure,
+                      metrics_record, stream_gzip, timings_line, write_metrics)
 
 POISONPILL = "Grim Reaper"
+# control messages peons put on the result queue, next to their results
+PEON_JOINED = "Reporting for duty"
+PEON_LEFT = "Job's done"
+PEON_TOOK = "Work work"
+# seconds to block on a queue before reporting the state and blocking again
+QUEUE_TIMEOUT = 30
+# seconds between two checks of the chunck leases on the server
+LEASE_TICK = 1
+# seconds a peon keeps finished chuncks to send them as one batch
+BATCH_SECONDS = 5
+# seconds the server stays up after answering from the cache, so clients started along
+# with it can still connect and take the poison pill instead of failing to connect
+HIT_GRACE = 10
 
 def parse_arguments():
     """
@@ -40,6 +58,24 @@ def parse_arguments():
                         required=False, help="CSV file om de output in op te slaan. Default is output naar terminal STDOUT")
     server_args.add_argument("fastq_files", action="store", type=ap.FileType('r'), nargs='*', help="Minstens 1 Illumina Fastq Format file om te verwerken")
     server_args.add_argument("--chunks", action="store", type=int, required=False)
+    server_args.add_argument("--lease", action="store", type=float, default=300, required=False,
+                        help="Seconds a peon gets for a chunck before it is handed out again (default 300)")
+    server_args.add_argument("--window", action="store", type=int, default=64, required=False,
+                        help="Maximum number of chuncks in flight, and size of the job and result queues (default 64)")
+    server_args.add_argument("--metrics", action="store", required=False,
+                        help="Append measurements of every chunck, made by the peons, as JSON lines to this file")
+    server_args.add_argument("--cache", action="store_true", required=False,
+                        help="Reuse the sums and counts of a file that was processed before, without handing out any chuncks")
+    server_args.add_argument("--cache-dir", action="store", dest="cache_dir", default=CACHE_DIR, required=False,
+                        help=f"Directory of the result cache (default {CACHE_DIR}, or $BDC_CACHE)")
+    server_args.add_argument("--cache-size", action="store", dest="cache_size", type=int, default=64, required=False,
+                        help="Size limit of the result cache in MB; least recently used files are removed first (default 64)")
+    server_args.add_argument("--index", action="store_true", required=False,
+                        help="Split on record count using a .fqi index of every --index-interval-th record")
+    server_args.add_argument("--index-interval", action="store", dest="index_interval", type=int, default=1000,
+                        required=False, help="Amount of records between two offsets in the .fqi index (default 1000)")
+    server_args.add_argument("--timings", action="store_true", required=False,
+                        help="Print the time spent per phase (read, parse, reduce, write) as a [Timings] line at the end")
 
     client_args = argparser.add_argument_group(title="Arguments when run in client mode")
     client_args.add_argument("-n", action="store",
@@ -51,13 +87,16 @@ def parse_arguments():
     return argparser.parse_args()
 
 
-def make_server_manager(port, authkey, host):
+def make_server_manager(port, authkey, host, calculators, window):
     """ 
     Create a manager for the server, listening on the given port.
-    Return a manager object with get_job_q and get_result_q methods.
+    Return a manager object with get_job_q, get_result_q and get_calculators methods.
+    Clients fetch the calculators once, so jobs only have to carry a file id and a range.
+    Both queues hold at most window items; peons block on a full result queue until
+    the server catches up.
     """
-    job_q = queue.Queue()
-    result_q = queue.Queue()
+    job_q = queue.Queue(maxsize=window)
+    result_q = queue.Queue(maxsize=window)
 
     class QueueManager(BaseManager):
         """
@@ -66,6 +105,7 @@ def make_server_manager(port, authkey, host):
 
     QueueManager.register('get_job_q', callable=lambda: job_q)
     QueueManager.register('get_result_q', callable=lambda: result_q)
+    QueueManager.register('get_calculators', callable=lambda: calculators)
 
     manager = QueueManager(address=(host, port), authkey=authkey)
     manager.start()
@@ -73,57 +113,308 @@ def make_server_manager(port, authkey, host):
     return manager
 
 
-def runserver(port, host, file, n_chuncks, outputfile):
+class LeaseTracker:
+    """
+    Keeps track of every chunck the server hands out. A chunck gets a lease when a
+    peon takes it; when the lease expires the chunck is put back on the queue. Near
+    the end of a run, the slowest running chuncks are also handed out a second time
+    to idle peons, and whichever result comes in first is kept.
+
+    Functions:
+    - add: registers a new job
+    - take: starts the lease of a chunck when a peon takes it
+    - renew: renews the lease of a finished chunck whose result a peon still holds
+    - finish: marks a chunck as done, only the first time
+    - expired: jobs whose lease ran out, to put back on the queue
+    - speculate: duplicate jobs for the slowest chuncks when peons are idle
+    """
+
+    def __init__(self, lease):
+        """
+        Initiator.
+
+        args:
+        - lease: seconds a peon gets to finish a chunck
+        """
+        self.lease = lease
+        self.jobs = {}
+        self.waiting = {}
+        self.running = {}
+        self.speculated = set()
+        self.n_done = 0
+
+    def add(self, chunck_id, job):
+        """
+        Registers a job that has just been put on the queue.
+        """
+        self.jobs[chunck_id] = job
+        self.waiting[chunck_id] = 1
+
+    def take(self, chunck_id):
+        """
+        Starts (or renews) the lease of a chunck that a peon just took.
+        """
+        if chunck_id in self.jobs:
+            self.waiting[chunck_id] -= 1
+            self.running[chunck_id] = time.monotonic()
+
+    def renew(self, chunck_id):
+        """
+        Renews the lease of a chunck that a peon finished, but holds on to for its next batch.
+        """
+        if chunck_id in self.running:
+            self.running[chunck_id] = time.monotonic()
+
+    def finish(self, chunck_id):
+        """
+        Marks a chunck as done.
+
+        returns:
+        - True for the first result of a chunck, False for duplicates
+        """
+        if chunck_id not in self.jobs:
+            return False
+        del self.jobs[chunck_id]
+        self.waiting.pop(chunck_id, None)
+        self.running.pop(chunck_id, None)
+        self.n_done += 1
+        return True
+
+    def expired(self):
+        """
+        returns:
+        - jobs whose lease expired without a copy left on the queue; they get a new lease
+        """
+        now = time.monotonic()
+        jobs = []
+        for chunck_id, started in self.running.items():
+            if now - started > self.lease and not self.waiting[chunck_id]:
+                self.waiting[chunck_id] += 1
+                self.running[chunck_id] = now
+                jobs.append(self.jobs[chunck_id])
+        return jobs
+
+    def speculate(self, n_peons):
+        """
+        Once every chunck has been taken, hands the longest running chuncks out
+        a second time, one for every peon without work.
+
+        returns:
+        - duplicate jobs to put on the queue
+        """
+        if any(self.waiting.values()):
+            return []
+        idle = n_peons - len(self.running)
+        slowest = sorted((started, chunck_id) for chunck_id, started in self.running.items()
+                         if chunck_id not in self.speculated)
+        jobs = []
+        for _, chunck_id in slowest[:max(idle, 0)]:
+            self.speculated.add(chunck_id)
+            self.waiting[chunck_id] += 1
+            jobs.append(self.jobs[chunck_id])
+        return jobs
+
+
+def hand_out(jobs, tracker, job_q, window, retry):
+    """
+    Tops the job queue up until window chuncks are in flight, without ever blocking
+    on a queue still holding stale copies of finished chuncks. Chuncks that are handed
+    out again go first; whatever does not fit stays in retry for the next call. The
+    server is the only one putting jobs on the queue, so it never blocks there while
+    peons wait for it to take their results.
+
+    returns:
+    - False once every job has been handed out
+    """
+    while retry:
+        try:
+            job_q.put_nowait(retry[0])
+        except queue.Full:
+            return True
+        retry.popleft()
+
+    while len(tracker.jobs) < window and not job_q.full():
+        job = next(jobs, None)
+        if job is None:
+            return False
+        tracker.add(job[1], job)
+        job_q.put(job)
+    return True
+
+
+def runserver(port, host, file, n_chuncks, outputfile, index_interval=None, lease=300, window=64, metrics=None,
+              cache=None, print_timings=False):
     """
     Runs the server by making a make_sever_manager() function,
     Also, this functions distributes the chuncks over different peons (workers).
-    Shuts down the server when there is no more work left to do.
+    Jobs are (file id, chunck id, start, end) tuples, or (file id, chunck id, records)
+    for streamed gzip files; results are (file id, [(chunck id, sums, counts, metrics), ...])
+    batches, where metrics is the measurement of the chunck when --metrics is used.
+    Chuncks whose lease expires are handed out again, and near the end the
+    slowest chuncks are duplicated; the first result of every chunck is kept.
+    At most window chuncks are in flight at once, and every result is merged into a
+    running total as soon as it arrives, so the server memory does not grow with the
+    number of chuncks.
+    Shuts down the server when there is no more work left to do. When the file is
+    found in the result cache, there is no work to begin with: the result is written
+    right away, and the server stays up for HIT_GRACE seconds, and until every peon
+    that joined has left, so clients are not needed but do not fail either.
+    With print_timings, the run is split into read (splitting the file and starting the
+    server), parse (the peons at work), reduce (merging their results) and write.
 
     Returns nothing.
     """
-    manager = make_server_manager(port, b"somesecretkey", host)
-    shared_job_q = manager.get_job_q()
-    shared_result_q = manager.get_result_q()
-
-    calculator = PhredScoreCalculator(file[0], n_chuncks)
-    calculator.make_chuncks()
-    chuncks = calculator.get_chunks()
-
     if not file:
         print("[Error] No data!")
         return
 
-    for chunck in chuncks:
-        shared_job_q.put({'fn': calculator.process_file, 'arg': chunck})
+    started = time.perf_counter()
+    calculator = PhredScoreCalculator(file[0], n_chuncks, totals=True, index_interval=index_interval,
+                                      metrics=metrics is not None)
+    key = fingerprint(calculator.fastq) if cache else None
+    cached = cache.load(key) if cache else None
+    if cached is not None:
+        print("[Status] Found the result in the cache, there is nothing to hand out.")
+    else:
+        _, timings = measure(calculator.make_chuncks)
+        if metrics:
+            write_metrics(metrics, [metrics_record("split", "network", calculator.fastq, **timings,
+                                                   chuncks=len(calculator.get_chunks()))])
+    chuncks = calculator.get_chunks()
+
+    manager = make_server_manager(port, b"somesecretkey", host, [calculator], window)
+    shared_job_q = manager.get_job_q()
+    shared_result_q = manager.get_result_q()
 
-    time.sleep(2)
-    results = []
+    if cached is not None:
+        work = iter(())
+    elif calculator.compression == "gzip":
+        # plain gzip cannot be split; the peons decode pieces while the rest is still being decompressed
+        # and only as fast as the window allows
+        work = ((piece,) for piece in stream_gzip(calculator.fastq))
+    else:
+        work = ((int(start), int(end)) for start, end in chuncks)
+    jobs = ((0, chunck_id, *job) for chunck_id, job in enumerate(work))
 
-    while True:
+    tracker = LeaseTracker(lease)
+    # expired and duplicate chuncks waiting for room on the job queue
+    retry = deque()
+    producing = hand_out(jobs, tracker, shared_job_q, window, retry)
+    read_seconds = time.perf_counter() - started
+    reduce_seconds = 0.0
+
+    totals = cached
+    peons = set()
+    last_message = time.monotonic()
+
+    while producing or tracker.jobs:
         try:
-            result = shared_result_q.get_nowait()
-            results.append(result)
-            if len(results) == len(chuncks):
-                print("[Status] All records have been processed.")
-                break
+            message = shared_result_q.get(timeout=LEASE_TICK)
+            last_message = time.monotonic()
         except queue.Empty:
-            time.sleep(1)
-            continue
+            message = None
+            if time.monotonic() - last_message > QUEUE_TIMEOUT:
+                print(f"[Status] Waiting for results: {tracker.n_done} chuncks done, {len(tracker.jobs)} in flight on {len(peons)} peons.")
+                last_message = time.monotonic()
+
+        if message is None or track_peons(message, peons):
+            pass
+        elif message[0] == PEON_TOOK:
+            tracker.take(message[2])
+            for chunck_id in message[3]:
+                tracker.renew(chunck_id)
+        else:
+            # clients batch their chuncks before sending; duplicates of finished chuncks are dropped
+            _, batch = message
+            records = []
+            before = time.perf_counter()
+            for chunck_id, sums, counts, record in batch:
+                first = tracker.finish(chunck_id)
+                if first:
+                    totals = calculator.merge_totals([(sums, counts)] if totals is None else [totals, (sums, counts)])
+                if record:
+                    records.append({**record, "chunck_id": chunck_id, "duplicate": not first})
+            reduce_seconds += time.perf_counter() - before
+            if records:
+                write_metrics(metrics, records)
+
+        for job in tracker.expired():
+            print(f"[Status] Lease of chunck {job[1]} expired, handing it out again.")
+            retry.append(job)
+        # duplicates only make sense once there is nothing new left to hand out
+        for job in tracker.speculate(len(peons)) if not producing else []:
+            print(f"[Status] Chunck {job[1]} is slow, handing out a second copy.")
+            retry.append(job)
+        if producing or retry:
+            producing = hand_out(jobs, tracker, shared_job_q, window, retry)
+    print("[Status] All records have been processed.")
 
     print("[Status] Time to kill some peons!")
+    # whatever is left on the job queue are copies of finished chuncks; they make room for the pill
+    while True:
+        try:
+            shared_job_q.get_nowait()
+        except queue.Empty:
+            break
     shared_job_q.put(POISONPILL)
 
-    time.sleep(10)
+    def write():
+        write_started = time.perf_counter()
+        if cache and cached is None and totals is not None:
+            cache.store(key, totals)
+        averages, timings = measure(calculator.calculate_average, [] if totals is None else [totals])
+        if metrics:
+            write_metrics(metrics, [metrics_record("average", "network", calculator.fastq, **timings,
+                                                   positions=len(averages))])
+
+        if outputfile:
+            calculator.csv_writer(averages, outputfile=outputfile, multiple=False)
+        else:
+            for position, value in averages.items():
+                print(f"{position}, {value}")
+        if print_timings:
+            end = time.perf_counter()
+            print(timings_line(read_seconds, write_started - started - read_seconds - reduce_seconds, reduce_seconds,
+                               end - write_started, end - started))
+
+    if cached is not None:
+        write()
+        print(f"[Status] Waiting {HIT_GRACE} seconds for clients to stop them.")
+        deadline = time.monotonic() + HIT_GRACE
+        while time.monotonic() < deadline:
+            try:
+                track_peons(shared_result_q.get(timeout=LEASE_TICK), peons)
+            except queue.Empty:
+                pass
+
+    # completion barrier: only shut down once every peon that joined has left
+    while peons:
+        try:
+            track_peons(shared_result_q.get(timeout=QUEUE_TIMEOUT), peons)
+        except queue.Empty:
+            print(f"[Warning] {len(peons)} peons did not report back, shutting down anyway.")
+            break
     print("[Status] Shutting down the server...")
 
     manager.shutdown()
-    averages = calculator.calculate_average([res["result"] for res in results])
+    if cached is None:
+        write()
 
-    if outputfile:
-        calculator.csv_writer(averages, outputfile=outputfile, multiple=False)
+
+def track_peons(message, peons):
+    """
+    Keeps track of the peons that joined and left through their control messages.
+
+    returns:
+    - True when the message was a control message, False for a result
+    """
+    if message[0] == PEON_JOINED:
+        peons.add(message[1])
+    elif message[0] == PEON_LEFT:
+        peons.discard(message[1])
     else:
-        for key, value in averages.items():
-            print(f"{key}, {value}")
+        return False
+    return True
 
 
 def make_client_manager(port, authkey, host):
@@ -139,6 +430,7 @@ def make_client_manager(port, authkey, host):
 
     ServerQueueManager.register('get_job_q')
     ServerQueueManager.register('get_result_q')
+    ServerQueueManager.register('get_calculators')
 
     manager = ServerQueueManager(address=(host, port), authkey=authkey)
     manager.connect()
@@ -155,10 +447,11 @@ def runclient(num_processes, host, port):
     manager = make_client_manager(port, b"somesecretkey", host)
     job_q = manager.get_job_q()
     result_q = manager.get_result_q()
-    run_workers(job_q, result_q, num_processes)
+    calculators = manager.get_calculators()._getvalue()
+    run_workers(job_q, result_q, num_processes, calculators)
 
 
-def run_workers(job_q, result_q, num_processes):
+def run_workers(job_q, result_q, num_processes, calculators):
     """
     This function makes sure the right amount of peons start working;
     each chunck gets its own peon (worker). Puts results into
@@ -166,7 +459,7 @@ def run_workers(job_q, result_q, num_processes):
     """
     processes = []
     for _ in range(num_processes):
-        temp = mp.Process(target=peon, args=(job_q, result_q))
+        temp = mp.Process(target=peon, args=(job_q, result_q, calculators))
         processes.append(temp)
         temp.start()
     print(f"[Status] Started {len(processes)} workers!")
@@ -174,33 +467,80 @@ def run_workers(job_q, result_q, num_processes):
         temp.join()
 
 
-def peon(job_q, result_q):
+def send_totals(result_q, totals):
+    """
+    Sends the batched sums and counts of a peon to the server, one message per file,
+    and empties them.
+    """
+    for file_id, batch in totals.items():
+        result_q.put((file_id, batch))
+    totals.clear()
+
+
+def peon(job_q, result_q, calculators):
     """
     Defines the logic behind a peon. Runs until the queue is empty, and
     adds results to the result_q. The peon is killed if either the POISONPILL
-    is added to the queue, or when there is no more work to do.
+    is added to the queue, or when the server goes away.
+    Results are batched locally and sent as one message once the batch is
+    BATCH_SECONDS old, or as soon as the queue runs dry; then the peon blocks until
+    the next job arrives instead of polling. Every chunck that a peon takes renews
+    the leases of the results it still holds, so a batch never outlives a lease.
+    Every chunck stays a separate (chunck id, sums, counts, metrics) entry, so the
+    server can drop duplicates of re-issued chuncks.
     """
     my_name = mp.current_process().name
-    while True:
-        try:
-            job = job_q.get_nowait()
-            print(job)
+    totals = {}
+    batch_started = time.monotonic()
+    try:
+        result_q.put((PEON_JOINED, my_name))
+        while True:
+            try:
+                job = job_q.get_nowait()
+            except queue.Empty:
+                send_totals(result_q, totals)
+                try:
+                    job = job_q.get(timeout=QUEUE_TIMEOUT)
+                except queue.Empty:
+                    print(f"[Status] {my_name} is waiting for work")
+                    continue
+
             if job == POISONPILL:
                 print('done')
+                send_totals(result_q, totals)
                 job_q.put(POISONPILL)
+                result_q.put((PEON_LEFT, my_name))
                 print(f"[Status] Killing: {my_name}")
                 return
-            else:
-                try:
-                    result = job['fn'](job['arg'])
-                    print(f"[Status] Peon {my_name} is workin   g on: {job['arg']}")
-                    result_q.put({'job': job, 'result': result})
-                except NameError:
-                    print(f"[ERROR] We cannot find {my_name} anywhere...")
-                    result_q.put({'job': job, 'result': "No results!"})
-        except queue.Empty:
-            print(f"Closing {my_name}")
-            time.sleep(5)
+
+            file_id, chunck_id = job[:2]
+            calculator = calculators[file_id]
+            result_q.put((PEON_TOOK, file_id, chunck_id, [entry[0] for entry in totals.get(file_id, [])]))
+            record = None
+            try:
+                if len(job) == 3:
+                    # streamed gzip jobs carry the decompressed records themselves
+                    work, function = job[2], decode_qualities
+                    print(f"[Status] Peon {my_name} is workin   g on: {len(job[2])} bytes")
+                else:
+                    work, function = tuple(job[2:]), calculator.process_file
+                    print(f"[Status] Peon {my_name} is workin   g on: {job[2:]}")
+                if calculator.metrics:
+                    (sums, counts), timings = measure(function, work)
+                    record = metrics_record("chunck", "network", calculator.fastq, peon=my_name, **timings,
+                                            **chunck_metrics(work, (sums, counts)))
+                else:
+                    sums, counts = function(work)
+            except NameError:
+                print(f"[ERROR] We cannot find {my_name} anywhere...")
+                sums, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            if not totals:
+                batch_started = time.monotonic()
+            totals.setdefault(file_id, []).append((chunck_id, sums, counts, record))
+            if time.monotonic() - batch_started >= BATCH_SECONDS:
+                send_totals(result_q, totals)
+    except (EOFError, ConnectionError):
+        print(f"[Status] Lost the server, closing {my_name}")
 
 
 if __name__ == "__main__":
@@ -212,7 +552,8 @@ if __name__ == "__main__":
 
     if args.s:
         args.csvfile = None if not hasattr(args, 'csvfile') else args.csvfile
-        server = mp.Process(target=runserver, args=(args.port, args.host, args.fastq_files, args.chunks, args.csvfile))
+        cache = ResultCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+        server = mp.Process(target=runserver, args=(args.port, args.host, args.fastq_files, args.chunks, args.csvfile, args.index_interval if args.index else None, args.lease, args.window, args.metrics, cache, args.timings))
         server.start()
         time.sleep(1)
 
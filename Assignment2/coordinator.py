@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+
+"""Big Data Computing (BDC) assignment 2, long-lived coordinator.
+
+A single asyncio event loop keeps the connections of many workers open and accepts
+FastQ jobs from any number of submitters. Workers stay connected across jobs and
+keep their process pool alive, so a new job starts without reconnecting or spawning
+processes, and chuncks of several files are handed out round-robin at the same time.
+
+Usage:
+    Start the coordinator:
+        python3 coordinator.py -s --host <een workstation> --port <een poort>
+    Start a worker:
+        python3 coordinator.py -c --host <host van de coordinator> --port <poort> -n <aantal cpus>
+    Submit jobs:
+        python3 coordinator.py -j --host <host van de coordinator> --port <poort> --chunks <een getal> [-o <output csv file>] rnaseqfile.fastq [...]
+"""
+
+__author__ = "Dennis Scheper"
+__status__ = "Production"
+__version__ = "v1.0"
+__date__ = "30/05/2024"
+__contact__ = "d.j.scheper@st.hanze.nl"
+
+import argparse as ap
+import asyncio
+import hmac
+import itertools
+import json
+import os
+import struct
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from phred import PhredScoreCalculator
+# importing phred puts phredlib, at the root of the repository, on sys.path
+from phredlib import (CACHE_DIR, ResultCache, decode_qualities, decode_windows, fingerprint, inflate_bgzf,
+                      map_chunck, stream_gzip)
+
+AUTHKEY = b"somesecretkey"
+# header size and payload size in front of every message
+FRAME = struct.Struct("!IQ")
+# chuncks waiting per job before its producer has to wait; keeps streamed gzip pieces in check
+QUEUE_LIMIT = 16
+
+
+def parse_arguments():
+    """
+    Defines command-line arguments.
+    """
+    argparser = ap.ArgumentParser(description="Long-lived coordinator voor Opdracht 2 van Big Data Computing; Calculate PHRED scores over the network.")
+    mode = argparser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("-s", action="store_true", help="Run the coordinator service")
+    mode.add_argument("-c", action="store_true", help="Run a worker that stays connected across jobs")
+    mode.add_argument("-j", action="store_true", help="Submit FastQ files to the coordinator and wait for the results")
+    argparser.add_argument("--host", action="store", type=str, required=True, help="The hostname of the coordinator")
+    argparser.add_argument("--port", action="store", type=int, required=True, help="The port of the coordinator")
+
+    service_args = argparser.add_argument_group(title="Arguments when run as the coordinator")
+    service_args.add_argument("--cache", action="store_true", required=False,
+                              help="Answer jobs for files that were processed before from the result cache")
+    service_args.add_argument("--cache-dir", action="store", dest="cache_dir", default=CACHE_DIR, required=False,
+                              help=f"Directory of the result cache (default {CACHE_DIR}, or $BDC_CACHE)")
+    service_args.add_argument("--cache-size", action="store", dest="cache_size", type=int, default=64, required=False,
+                              help="Size limit of the result cache in MB; least recently used files are removed first (default 64)")
+
+    worker_args = argparser.add_argument_group(title="Arguments when run as a worker")
+    worker_args.add_argument("-n", action="store", dest="n", type=int, default=os.cpu_count(),
+                             help="Aantal cores om te gebruiken per host.")
+
+    job_args = argparser.add_argument_group(title="Arguments when submitting jobs")
+    job_args.add_argument("--chunks", action="store", type=int, default=16, help="Aantal chunks per file")
+    job_args.add_argument("-o", action="store", dest="csvfile", type=ap.FileType('w', encoding='UTF-8'),
+                          required=False, help="CSV file om de output in op te slaan. Default is output naar terminal STDOUT")
+    job_args.add_argument("fastq_files", action="store", type=ap.FileType('r'), nargs='*',
+                          help="Illumina Fastq Format files om te verwerken")
+    return argparser.parse_args()
+
+
+async def read_message(reader):
+    """
+    Reads one framed message: a JSON header followed by an optional binary payload.
+
+    returns:
+    - (header, payload)
+    """
+    header_size, payload_size = FRAME.unpack(await reader.readexactly(FRAME.size))
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return header, payload
+
+
+def write_message(writer, header, payload=b""):
+    """
+    Writes one framed message; the caller drains the writer.
+    """
+    data = json.dumps(header).encode()
+    writer.write(FRAME.pack(len(data), len(payload)) + data)
+    if payload:
+        writer.write(payload)
+
+
+def pack_totals(sums, counts):
+    """
+    Packs per-position sums and counts into one little-endian int64 payload.
+    """
+    return np.stack((sums, counts)).astype("<i8").tobytes()
+
+
+def unpack_totals(payload):
+    """
+    Unpacks a payload made by pack_totals.
+
+    returns:
+    - (sums, counts)
+    """
+    sums, counts = np.frombuffer(payload, dtype="<i8").reshape(2, -1)
+    return sums, counts
+
+
+async def challenge(reader, writer):
+    """
+    Coordinator side of the handshake: the peer has to sign a random nonce with the authkey.
+
+    returns:
+    - True when the peer knows the authkey
+    """
+    nonce = os.urandom(32)
+    write_message(writer, {"type": "challenge", "nonce": nonce.hex()})
+    await writer.drain()
+    header, _ = await read_message(reader)
+    expected = hmac.new(AUTHKEY, nonce, "sha256").hexdigest()
+    return hmac.compare_digest(header.get("digest", ""), expected)
+
+
+async def answer_challenge(reader, writer):
+    """
+    Peer side of the handshake.
+    """
+    header, _ = await read_message(reader)
+    digest = hmac.new(AUTHKEY, bytes.fromhex(header["nonce"]), "sha256").hexdigest()
+    write_message(writer, {"type": "answer", "digest": digest})
+    await writer.drain()
+
+
+class Job:
+    """
+    State of a single submitted FastQ file on the coordinator.
+    """
+
+    def __init__(self, job_id, calculator, writer, key=None):
+        """
+        Initiator.
+
+        args:
+        - job_id: number of the job
+        - calculator: PhredScoreCalculator of the file
+        - writer: stream of the submitter, to send the result to
+        - key: fingerprint of the file in the result cache
+        """
+        self.job_id = job_id
+        self.calculator = calculator
+        self.writer = writer
+        self.key = key
+        self.produced = 0
+        self.received = 0
+        self.producing = True
+        self.totals = None
+
+    def add(self, sums, counts):
+        """
+        Merges the result of one chunck into the running totals.
+        """
+        parts = [(sums, counts)] if self.totals is None else [self.totals, (sums, counts)]
+        self.totals = self.calculator.merge_totals(parts)
+        self.received += 1
+
+    def finished(self):
+        """
+        returns:
+        - True once every chunck has been produced and processed
+        """
+        return not self.producing and self.received == self.produced
+
+
+class Coordinator:
+    """
+    Long-lived asyncio service that hands out chuncks of many jobs to many workers.
+
+    Functions:
+    - handle: entry point of every connection; routes workers and submitters
+    - run_job: splits a submitted file into chuncks and queues them
+    - next_chunck: picks the next chunck, round-robin over the running jobs
+    - serve_worker: streams chuncks to a worker and collects its results
+    - fail: drops a job that cannot be finished and tells its submitter why
+    """
+
+    def __init__(self, cache=None):
+        """
+        Initiator.
+
+        args:
+        - cache: ResultCache to answer known files from, and to add finished jobs to
+
+        self.queues: chuncks waiting to be handed out, per job
+        self.work: condition that is notified whenever self.queues changes
+        """
+        self.cache = cache
+        self.jobs = {}
+        self.queues = OrderedDict()
+        self.work = asyncio.Condition()
+        self.job_ids = itertools.count()
+
+    async def handle(self, reader, writer):
+        """
+        Handles one connection, from a worker or from a submitter.
+        """
+        peer = writer.get_extra_info("peername")
+        try:
+            if not await challenge(reader, writer):
+                print(f"[Error] {peer} does not know the authkey.")
+                return
+            header, _ = await read_message(reader)
+            if header["type"] == "worker":
+                print(f"[Status] Worker {peer} connected with {header['slots']} slots.")
+                await self.serve_worker(reader, writer, header["slots"])
+            elif header["type"] == "submit":
+                await self.serve_submitter(reader, writer, header)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"[Status] Lost connection with {peer}.")
+        finally:
+            writer.close()
+
+    async def serve_submitter(self, reader, writer, header):
+        """
+        Starts a job for every file in the submission, then waits until the submitter hangs up.
+        """
+        tasks = [asyncio.create_task(self.run_job(path, header["chunks"], writer)) for path in header["paths"]]
+        await asyncio.gather(*tasks)
+        await reader.read()
+
+    async def run_job(self, path, n_chuncks, writer):
+        """
+        Splits a file into chuncks and queues them. Plain gzip files are streamed as
+        pieces of records, and wait whenever the job already has QUEUE_LIMIT pieces queued.
+        Files found in the result cache are done right away, without any chuncks.
+        Files are opened off the event loop; a file that cannot be read is answered
+        with an error instead of a job.
+        """
+        try:
+            calculator = await asyncio.to_thread(open_calculator, path, n_chuncks)
+            key = await asyncio.to_thread(fingerprint, path) if self.cache else None
+        except OSError as err:
+            print(f"[Error] Could not start a job for {path}: {err}")
+            await self.notify(writer, {"type": "error", "path": path, "error": str(err)})
+            return
+        job = Job(next(self.job_ids), calculator, writer, key)
+        self.jobs[job.job_id] = job
+        self.queues[job.job_id] = deque()
+        write_message(writer, {"type": "accepted", "job": job.job_id, "path": path})
+        await writer.drain()
+        print(f"[Status] Job {job.job_id} started for {path}.")
+
+        cached = self.cache.load(key) if self.cache else None
+        try:
+            if cached is not None:
+                print(f"[Status] Job {job.job_id} found in the cache.")
+                job.totals = cached
+                # already in the cache, nothing to store once the job completes
+                job.key = None
+            elif calculator.compression == "gzip":
+                pieces = stream_gzip(calculator.fastq)
+                while (piece := await asyncio.to_thread(next, pieces, None)) is not None:
+                    if not await self.put_chunck(job, {"start": None, "end": None}, piece):
+                        return
+            else:
+                await asyncio.to_thread(calculator.make_chuncks)
+                for start, end in calculator.get_chunks():
+                    if not await self.put_chunck(job, {"start": int(start), "end": int(end)}):
+                        return
+        except (OSError, EOFError) as err:
+            await self.fail(job, str(err))
+            return
+
+        job.producing = False
+        await self.complete(job)
+
+    async def put_chunck(self, job, header, payload=b""):
+        """
+        Queues one chunck of a job.
+
+        returns:
+        - False when the job failed meanwhile, and no more chuncks should be queued
+        """
+        header = {"type": "chunck", "job": job.job_id, "path": job.calculator.fastq,
+                  "compression": job.calculator.compression, **header}
+        async with self.work:
+            await self.work.wait_for(lambda: job.job_id not in self.queues
+                                     or len(self.queues[job.job_id]) < QUEUE_LIMIT)
+            if job.job_id not in self.queues:
+                return False
+            self.queues[job.job_id].append((header, payload))
+            job.produced += 1
+            self.work.notify_all()
+        return True
+
+    async def next_chunck(self):
+        """
+        Waits for the next chunck. Jobs take turns, so several files are processed at once.
+
+        returns:
+        - (header, payload) of the chunck
+        """
+        async with self.work:
+            await self.work.wait_for(lambda: any(self.queues.values()))
+            job_id = next(job_id for job_id, chuncks in self.queues.items() if chuncks)
+            self.queues.move_to_end(job_id)
+            self.work.notify_all()
+            return self.queues[job_id].popleft()
+
+    async def requeue(self, chuncks):
+        """
+        Puts the chuncks of a lost worker back in front of their queues, except
+        those of jobs that failed meanwhile.
+        """
+        async with self.work:
+            for header, payload in chuncks:
+                if header["job"] in self.queues:
+                    self.queues[header["job"]].appendleft((header, payload))
+            self.work.notify_all()
+
+    async def serve_worker(self, reader, writer, slots):
+        """
+        Streams chuncks to a worker, at most one per slot at a time, and merges its
+        results into their jobs. Chuncks of a worker that disconnects are queued again;
+        a chunck the worker could not process fails its job, as it would fail again.
+        """
+        free = asyncio.Semaphore(slots)
+        outstanding = {}
+        keys = itertools.count()
+
+        async def send():
+            while True:
+                await free.acquire()
+                header, payload = await self.next_chunck()
+                key = next(keys)
+                outstanding[key] = (header, payload)
+                write_message(writer, {**header, "key": key}, payload)
+                await writer.drain()
+
+        sender = asyncio.create_task(send())
+        try:
+            while True:
+                header, payload = await read_message(reader)
+                chunck, _ = outstanding.pop(header["key"])
+                free.release()
+                job = self.jobs.get(chunck["job"])
+                if job is None:
+                    # the job failed on another chunck meanwhile
+                    continue
+                if header["type"] == "error":
+                    await self.fail(job, f"chunck {chunck['start']}-{chunck['end']}: {header['error']}")
+                    continue
+                job.add(*unpack_totals(payload))
+                await self.complete(job)
+        finally:
+            sender.cancel()
+            if outstanding:
+                print(f"[Status] Handing {len(outstanding)} chuncks of a lost worker out again.")
+                await self.requeue(outstanding.values())
+
+    async def complete(self, job):
+        """
+        Sends the totals of a finished job to its submitter and forgets the job.
+        """
+        if not job.finished() or job.job_id not in self.jobs:
+            return
+        del self.jobs[job.job_id]
+        async with self.work:
+            del self.queues[job.job_id]
+        sums, counts = job.totals if job.totals is not None else (np.zeros(0), np.zeros(0))
+        if self.cache and job.key and job.totals is not None:
+            self.cache.store(job.key, job.totals)
+        print(f"[Status] Job {job.job_id} done.")
+        await self.notify(job.writer, {"type": "done", "job": job.job_id}, pack_totals(sums, counts))
+
+    async def fail(self, job, error):
+        """
+        Drops a job and its queued chuncks, and sends the error to its submitter.
+        Results of its chuncks that are still out are ignored when they come in.
+        """
+        if job.job_id not in self.jobs:
+            return
+        del self.jobs[job.job_id]
+        async with self.work:
+            del self.queues[job.job_id]
+            self.work.notify_all()
+        print(f"[Error] Job {job.job_id} failed: {error}")
+        await self.notify(job.writer, {"type": "error", "job": job.job_id, "path": job.calculator.fastq,
+                                       "error": error})
+
+    @staticmethod
+    async def notify(writer, header, payload=b""):
+        """
+        Sends a message to a submitter, which may have hung up already.
+        """
+        try:
+            write_message(writer, header, payload)
+            await writer.drain()
+        except ConnectionError:
+            print(f"[Status] Submitter {writer.get_extra_info('peername')} is gone.")
+
+
+async def serve(host, port, cache=None):
+    """
+    Runs the coordinator until it is killed.
+    """
+    coordinator = Coordinator(cache)
+    server = await asyncio.start_server(coordinator.handle, host, port)
+    print(f'[Status] Coordinator started at {host} : {port}')
+    async with server:
+        await server.serve_forever()
+
+
+def open_calculator(path, n_chuncks):
+    """
+    Sets up the calculator of a submitted file; runs in a thread, as it reads the file.
+
+    returns:
+    - PhredScoreCalculator of the file
+    """
+    with open(path, 'rb') as fastq:
+        return PhredScoreCalculator(fastq, n_chuncks, totals=True)
+
+
+def process_chunck(header, payload):
+    """
+    Decodes one chunck inside a worker process.
+
+    returns:
+    - (sums, counts)
+    """
+    if header["compression"] == "gzip":
+        return decode_windows(payload)
+    if header["compression"] == "bgzf":
+        return decode_windows(inflate_bgzf(header["path"], header["start"], header["end"]))
+    return decode_windows(map_chunck(header["path"], header["start"], header["end"]))
+
+
+async def run_worker(host, port, n):
+    """
+    Connects to the coordinator once and processes chuncks of any job until the
+    coordinator goes away. The process pool lives as long as the connection.
+    A chunck that fails is answered with an error, so the coordinator does not
+    wait for its result forever.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    await answer_challenge(reader, writer)
+    write_message(writer, {"type": "worker", "slots": n})
+    await writer.drain()
+    print(f"[Status] Worker connected to {host} : {port} with {n} processes")
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def work(header, payload):
+        try:
+            sums, counts = await loop.run_in_executor(executor, process_chunck, header, payload)
+        except Exception as err:
+            print(f"[Error] Chunck {header['start']}-{header['end']} of {header['path']} failed: {err!r}")
+            write_message(writer, {"type": "error", "key": header["key"], "error": repr(err)})
+        else:
+            write_message(writer, {"type": "result", "key": header["key"]}, pack_totals(sums, counts))
+        await writer.drain()
+
+    with ProcessPoolExecutor(n) as executor:
+        try:
+            while True:
+                header, payload = await read_message(reader)
+                task = asyncio.create_task(work(header, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("[Status] Coordinator went away, stopping.")
+
+
+async def submit(host, port, files, n_chuncks, outputfile):
+    """
+    Submits FastQ files to the coordinator and writes the averages of every file
+    as soon as its job is done. Files the coordinator could not process are reported.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    await answer_challenge(reader, writer)
+    paths = [os.path.abspath(file.name) for file in files]
+    write_message(writer, {"type": "submit", "paths": paths, "chunks": n_chuncks})
+    await writer.drain()
+
+    calculators = {}
+    remaining = len(files)
+    while remaining:
+        header, payload = await read_message(reader)
+        if header["type"] == "accepted":
+            calculators[header["job"]] = files[paths.index(header["path"])]
+            print(f"[Status] Job {header['job']} accepted for {header['path']}.")
+            continue
+
+        remaining -= 1
+        if header["type"] == "error":
+            print(f"[Error] {header['path']} could not be processed: {header['error']}")
+            continue
+        file = calculators.pop(header["job"])
+        calculator = PhredScoreCalculator(file, n_chuncks, totals=True)
+        averages = calculator.calculate_average([unpack_totals(payload)])
+        if outputfile:
+            calculator.csv_writer(averages, outputfile=outputfile, multiple=len(files) > 1)
+        else:
+            for key, value in averages.items():
+                print(f"{key}, {value}")
+
+    writer.close()
+    await writer.wait_closed()
+
+
+def main():
+    """
+    Main function; starts the coordinator, a worker or a submission.
+    """
+    args = parse_arguments()
+    if args.s:
+        cache = ResultCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+        asyncio.run(serve(args.host, args.port, cache))
+    elif args.c:
+        asyncio.run(run_worker(args.host, args.port, args.n))
+    elif args.j:
+        if not args.fastq_files:
+            print("[Error] No data!")
+            return
+        asyncio.run(submit(args.host, args.port, args.fastq_files, args.chunks, args.csvfile))
+
+
+if __name__ == "__main__":
+    main()
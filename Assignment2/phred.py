@@ -2,40 +2,63 @@ import argparse as ap
 import csv
 import multiprocessing as mp
 import os
+import sys
 from collections import defaultdict
 import numpy as np 
 
+# the shared helpers live in phredlib.py at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from phredlib import (align_to_record, bgzf_blocks, decode_qualities, decode_windows, detect_compression,
+                      inflate_bgzf, load_index, map_chunck, measure, stream_gzip)
+
+
 class PhredScoreCalculator:
     """
     Class used to handle the processing of a FastQ file to Phred scores.
 
     Functions:
-    - make_chuncks: splits FastQ file into chuncks in bytes based on the amount of cores
+    - make_chuncks: splits FastQ file into record-aligned chuncks based on the amount of cores
     - get_chuncks: simply retrieve all chuncks
     - process_file: this function calculates the Phred score per base position per chunck
     - calculate_average: calculates the average Phred score per base position by concatenating
                          all chuncks into defaultdict
+    - merge_totals: adds the per-position sums and counts of all chuncks together
     - write_csv: used for writing the results to a CSV format
     """
 
-    def __init__(self, fastq, n):
+    def __init__(self, fastq, n, *, totals=False, index_interval=None, metrics=False):
         """
         Initiator. 
 
         args:
         - fastq: FastQ file to be processed
         - n: amount of cores
+        - totals: when True, every chunck is memory-mapped and decoded by the vectorized
+                  decode_qualities kernel, and returns fixed-size per-position sums and
+                  counts instead of a list of every single score. Always on for
+                  gzip/BGZF compressed files
+        - index_interval: when given, split on record count using a .fqi sidecar
+                          holding the offset of every index_interval-th record
+        - metrics: when True, peons measure every chunck and send the measurement
+                   back with its result
 
         self.chuncks: holds the chuncks defined by the make_chuncks function
         """
         self.fastq = fastq.name
         self.n = n
+        self.compression = detect_compression(self.fastq)
+        self.totals = totals or self.compression is not None
+        self.index_interval = index_interval
+        self.metrics = metrics
         self.chuncks = []
 
     def make_chuncks(self):
         """
         Determines how large a chunck is by calculating its start and end positions in bytes.
         The amount of chuncks is equal to the number of cores given by the user.
+        Every split point is snapped to the start of a record, or taken from the .fqi index
+        so every chunck holds the same amount of records. BGZF files are split on block
+        boundaries in compressed bytes, plain gzip files can only be one chunck.
         All start and end positions are appended to self.chuncks for easy access within the class.
         """
         try:
@@ -45,9 +68,21 @@ class PhredScoreCalculator:
 
         chunck_size = file_size // self.n
 
-        for i in range(self.n):
-            start = i * chunck_size
-            end = start + chunck_size if i < self.n - 1 else file_size
+        if self.compression == "bgzf":
+            blocks = bgzf_blocks(self.fastq)
+            starts = np.searchsorted(blocks, np.arange(self.n) * chunck_size)
+            bounds = [int(bound) for bound in np.append(blocks, file_size)[starts]]
+        elif self.compression == "gzip":
+            bounds = [0]
+        elif self.index_interval:
+            offsets = load_index(self.fastq, self.index_interval)
+            bounds = [int(offsets[(i * len(offsets)) // self.n]) for i in range(self.n)]
+        else:
+            with open(self.fastq, 'rb') as inputfile:
+                bounds = [align_to_record(inputfile, i * chunck_size) for i in range(self.n)]
+        bounds.append(file_size)
+
+        for start, end in zip(bounds, bounds[1:]):
             self.chuncks.append((start, end))
 
 
@@ -68,10 +103,20 @@ class PhredScoreCalculator:
         - chunck: chunck to be processed
 
         returns:
-        - phred_scores: defaultdict with Phred score per base position for said chunck
+        - phred_scores: defaultdict with Phred score per base position for said chunck,
+                        or a (sums, counts) tuple of int64 arrays in totals mode
         """
         # unpack the chunck's start and end positions
         start, end = chunck
+
+        if self.compression == "bgzf":
+            return decode_windows(inflate_bgzf(self.fastq, start, end))
+        if self.compression == "gzip":
+            return self.merge_totals([decode_qualities(piece) for piece in stream_gzip(self.fastq)])
+        if self.totals:
+            # chuncks are record-aligned, so the mapped range is decoded window by window
+            return decode_windows(map_chunck(self.fastq, start, end))
+
         # defaultdict makes adding more base positions more flexible
         phred_scores = defaultdict(list)
 
@@ -99,6 +144,10 @@ class PhredScoreCalculator:
         returns:
         - a defaultdict with the average phred score per base position
         """
+        if self.totals:
+            sums, counts = self.merge_totals(phred_scores)
+            return {pos: sums[pos] / counts[pos] for pos in range(len(sums)) if counts[pos]}
+
         combined = defaultdict(list)
 
         # combine every chunck into one dict
@@ -109,6 +158,27 @@ class PhredScoreCalculator:
         # then simply return the mean per base position
         return {key: np.mean(values) for key, values in combined.items()}
 
+    def merge_totals(self, totals):
+        """
+        Adds the per-position sums and counts of every chunck together. Chuncks
+        can hold reads of different lengths, so shorter arrays are padded first.
+
+        args:
+        - totals: list of (sums, counts) tuples
+
+        returns:
+        - one (sums, counts) tuple sized to the longest read
+        """
+        length = max((len(sums) for sums, _ in totals), default=0)
+        sums = np.zeros(length, dtype=np.int64)
+        counts = np.zeros(length, dtype=np.int64)
+
+        for sub_sums, sub_counts in totals:
+            sums[:len(sub_sums)] += sub_sums
+            counts[:len(sub_counts)] += sub_counts
+
+        return sums, counts
+
     
     def csv_writer(self, phred_scores, *, outputfile="output.csv", multiple=False):
         """
@@ -124,8 +194,9 @@ class PhredScoreCalculator:
         - average phred score per base position in CSV format
         """
         filename = os.path.basename(self.fastq) # get name of fastq file
-        name_output = outputfile if not multiple else f"{filename}.{outputfile}.csv"
-        with open(name_output.name, 'w', newline='', encoding='UTF-8') as csv_file:
+        directory, name = os.path.split(outputfile.name)
+        name_output = outputfile.name if not multiple else os.path.join(directory, f"{filename}.{name}")
+        with open(name_output, 'w', newline='', encoding='UTF-8') as csv_file:
             writer = csv.writer(csv_file)
             for key, value in phred_scores.items():
                 writer.writerow([key, value])
\ No newline at end of file
@@ -12,18 +12,39 @@ Usage:
     ./assignment3.sh [inputfiles]
 """
 
-from collections import defaultdict
 import argparse as ap
 import csv
-import ast
+import json
+import os
+import struct
 import sys
+import time
 import numpy as np
 
+# the shared helpers live in phredlib.py at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from phredlib import (CACHE_DIR, ResultCache, align_to_record, decode_qualities, decode_windows, fingerprint,
+                      map_chunck, measure, metrics_record, timings_line, write_metrics)
+
 __author__ = "Dennis Scheper (373689)"
 __status__ = "Work in progress..."
 __date__ = "23/06/2024"
 __contact__ = "d.j.scheper@st.hanze.nl"
 
+# every block is sent to the merge step as this header (magic, number of positions),
+# followed by the sums and then the counts as little-endian int64
+RECORD = struct.Struct("<4sI")
+MAGIC = b"PHRD"
+# --measure records travel in the same stream, as this magic and a number of bytes of JSON lines
+METRICS_MAGIC = b"PHRM"
+# a block should take the slowest worker about this many seconds, within these bounds
+BLOCK_SECONDS = 0.1
+BLOCK_BOUNDS = (1 << 18, 10 << 20)
+# with STAGED=1 a byte range should take the slowest worker about this many seconds
+RANGE_SECONDS = 2
+RANGE_BOUNDS = (16 << 20, 1 << 30)
+
+
 def parse_arguments():
     """
     Parses all arguments.
@@ -31,41 +52,306 @@ def parse_arguments():
     parser = ap.ArgumentParser(description="Big data computing assignment 3 by Dennis Scheper")
     parser.add_argument("--calculate", action="store_true", required=False,
                         help="Generate chunks.")
+    parser.add_argument("--worker", action="store_true", required=False,
+                        help="Long-lived worker; processes every block written to stdin until it closes.")
     parser.add_argument("--merge", action="store_true", required=False, help="Calculation option.")
+    parser.add_argument("--calibrate", action="store_true", required=False,
+                        help="Measure the throughput of one core on a sample block from stdin.")
+    parser.add_argument("--schedule", action="store_true", required=False,
+                        help="Turn 'host max_jobs cores MB/s' lines on stdin into an sshlogin, block size and range size.")
+    parser.add_argument("--ranges", action="store", type=int, required=False,
+                        help="Print record-aligned 'start end' byte ranges of about this many bytes of the given FastQ file.")
+    parser.add_argument("--range", action="store", type=int, nargs=2, required=False,
+                        help="Worker for a FastQ file present on this host; processes the bytes from START to END.")
+    parser.add_argument("--fingerprint", action="store_true", required=False,
+                        help="Print the result cache key of the given FastQ file.")
+    parser.add_argument("--lookup", action="store_true", required=False,
+                        help="Write the averages stored under --cache-key; exits with 1 when they are not in the cache.")
+    parser.add_argument("--cache-key", action="store", dest="cache_key", required=False,
+                        help="Result cache key of the file; with --merge the result is stored under it.")
+    parser.add_argument("--cache-dir", action="store", dest="cache_dir", default=CACHE_DIR, required=False,
+                        help=f"Directory of the result cache (default {CACHE_DIR}, or $BDC_CACHE).")
+    parser.add_argument("--cache-size", action="store", dest="cache_size", type=int, default=64, required=False,
+                        help="Size limit of the result cache in MB; least recently used files are removed first.")
     parser.add_argument("fastq_files", action="store", nargs='*', help="Minstens 1 Illumina Fastq Format file om te verwerken")
     parser.add_argument("-o", action="store", dest="csvfile", required=False, help="CSV file om de output in op te slaan. Default is output naar terminal STDOUT")
     parser.add_argument("-n", type=int, required=False)
+    parser.add_argument("--measure", action="store_true", required=False,
+                        help="With --worker or --range, measure every block and send the measurements along with the results.")
+    parser.add_argument("--metrics", action="store", required=False,
+                        help="With --merge, append the measurements of the workers and the merge step as JSON lines to this file.")
+    parser.add_argument("--timings", action="store", type=float, required=False,
+                        help="With --merge, print the time per phase as a [Timings] line; the value is the epoch time the pipeline started.")
     return parser.parse_args()
 
 
+def write_totals(sums, counts, output):
+    """
+    Writes the sums and counts of one block as a binary record.
+
+    Arguments:
+      - sums, counts: int64 arrays per base position
+      - output: binary stream to write to
+    """
+    output.write(RECORD.pack(MAGIC, len(sums)))
+    output.write(np.stack((sums, counts)).astype("<i8").tobytes())
+
+
+def write_measurements(records, output):
+    """
+    Writes --measure records as one binary record of JSON lines, so they reach the merge
+    step through the same stream as the results, from whichever host the worker ran on.
+
+    Arguments:
+      - records: list of metrics records
+      - output: binary stream to write to
+    """
+    data = "".join(json.dumps(record) + "\n" for record in records).encode()
+    output.write(RECORD.pack(METRICS_MAGIC, len(data)))
+    output.write(data)
+
+
+def read_totals(stream, measurements=None):
+    """
+    Reads the binary records written by write_totals one at a time.
+
+    Arguments:
+      - stream: binary stream with zero or more records
+      - measurements: list to add the records written by write_measurements to
+
+    Returns:
+      Yields a (sums, counts) tuple per record
+    """
+    while header := stream.read(RECORD.size):
+        if len(header) < RECORD.size:
+            raise ValueError("Truncated record header")
+        magic, length = RECORD.unpack(header)
+        if magic == METRICS_MAGIC:
+            data = stream.read(length)
+            if len(data) < length:
+                raise ValueError("Truncated measurements")
+            if measurements is not None:
+                measurements.extend(json.loads(line) for line in data.splitlines())
+            continue
+        if magic != MAGIC:
+            raise ValueError("Not a sums/counts record")
+        payload = stream.read(16 * length)
+        if len(payload) < 16 * length:
+            raise ValueError("Truncated record")
+        sums, counts = np.frombuffer(payload, dtype="<i8").reshape(2, length)
+        yield sums, counts
+
+
+def add_totals(totals, sub_totals):
+    """
+    Adds the sums and counts of a block to running totals; blocks can hold longer reads.
+
+    Arguments:
+      - totals: running (sums, counts) tuple
+      - sub_totals: (sums, counts) tuple of one block
+
+    Returns:
+      The new (sums, counts) tuple
+    """
+    (sums, counts), (sub_sums, sub_counts) = totals, sub_totals
+    if len(sub_sums) > len(sums):
+        sums = np.pad(sums, (0, len(sub_sums) - len(sums)))
+        counts = np.pad(counts, (0, len(sub_counts) - len(counts)))
+    sums[:len(sub_sums)] += sub_sums
+    counts[:len(sub_counts)] += sub_counts
+    return sums, counts
+
+
+def block_record(timings, size, sub_totals):
+    """
+    Makes the --measure record of one decoded block.
+
+    Arguments:
+      - timings: measurements of reading and decoding the block
+      - size: amount of bytes in the block
+      - sub_totals: (sums, counts) tuple of the block
+
+    Returns:
+      A metrics record
+    """
+    return metrics_record("chunck", "parallel", os.environ.get("FILE_NAME"), **timings, bytes=int(size),
+                          records=int(sub_totals[1][0]) if len(sub_totals[1]) else 0,
+                          result_bytes=RECORD.size + 16 * len(sub_totals[0]))
+
+
+def run_worker(block=1 << 22, measure_blocks=False):
+    """
+    Long-lived version of process_qline. GNU parallel writes many blocks of whole
+    records to the stdin of the same worker, so the stream is read in pieces that are
+    cut after every fourth newline, and the interpreter and NumPy only start once.
+    
+    Arguments: 
+      - block: amount of bytes to read at a time
+      - measure_blocks: keep a record per piece; the time spent waiting for GNU parallel
+                        to write the next piece counts as I/O wait
+      
+    Returns:
+      Writes one binary record with the totals of every block once stdin closes, and
+      one with the measurements when asked for
+    """
+    totals = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    records = []
+    rest = b""
+    with sys.stdin.buffer as input_data:
+        while True:
+            piece, read = measure(input_data.read, block)
+            final = not piece
+            data = rest + piece
+            if final:
+                cut = len(data)
+            else:
+                newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+                whole = len(newlines) // 4 * 4
+                cut = newlines[whole - 1] + 1 if whole else 0
+            sub_totals, timings = measure(decode_qualities, data[:cut])
+            totals = add_totals(totals, sub_totals)
+            rest = data[cut:]
+            if measure_blocks and cut:
+                for key in ("wall_seconds", "cpu_seconds", "io_wait_seconds"):
+                    timings[key] += read[key]
+                records.append(block_record(timings, cut, sub_totals))
+            if final:
+                break
+    started = time.perf_counter()
+    write_totals(*totals, sys.stdout.buffer)
+    if records:
+        records[-1]["serialize_seconds"] = time.perf_counter() - started
+        write_measurements(records, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+
+
+def run_range(fastq, start, end, measure_blocks=False):
+    """
+    Staged version of run_worker: the FastQ file is present on this host, so the
+    worker maps its own record-aligned byte range instead of having it streamed
+    from the submitting host. Only the range and the result cross the network.
+
+    Arguments:
+      - fastq: path to the FastQ file on this host
+      - start, end: byte range from split_ranges
+      - measure_blocks: send a record of the range along with the result
+
+    Returns:
+      Writes one binary record with the totals of the range, and one with the
+      measurement when asked for
+    """
+    # the mapping is read while it is decoded, so the measurement includes the disk
+    sub_totals, timings = measure(decode_windows, map_chunck(fastq, start, end))
+    write_totals(*sub_totals, sys.stdout.buffer)
+    if measure_blocks:
+        write_measurements([block_record(timings, end - start, sub_totals)], sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+
+
+def split_ranges(fastq, size):
+    """
+    Splits a FastQ file into byte ranges for run_range; every range starts at a record.
+
+    Arguments:
+      - fastq: path to the FastQ file
+      - size: amount of bytes per range, the last one may be shorter
+
+    Returns:
+      Prints a 'start end' line per range
+    """
+    with open(fastq, 'rb') as inputfile:
+        file_size = os.fstat(inputfile.fileno()).st_size
+        bounds = sorted({align_to_record(inputfile, offset) for offset in range(0, file_size, size)} | {file_size})
+    for start, end in zip(bounds, bounds[1:]):
+        print(start, end)
+
+
+def calibrate(seconds=1.0):
+    """
+    Calibration pass for the scheduler: decodes a sample block from stdin on one core
+    again and again for about the given amount of seconds. The slowest pass is
+    reported, so a host is not judged by a pass that ran while nothing else did.
+    
+    Arguments: 
+      - seconds: minimum duration of the measurement
+      
+    Returns:
+      Prints the amount of cores of this host and the throughput of its slowest pass in MB/s
+    """
+    data = sys.stdin.buffer.read()
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+    whole = len(newlines) // 4 * 4
+    data = data[:newlines[whole - 1] + 1] if whole else b""
+
+    slowest = 0.0
+    start = time.perf_counter()
+    while data and time.perf_counter() - start < seconds:
+        before = time.perf_counter()
+        decode_qualities(data)
+        slowest = max(slowest, time.perf_counter() - before)
+    print(f"{os.cpu_count()} {len(data) / slowest / 1e6 if slowest else 0:.1f}")
+
+
+def schedule(lines):
+    """
+    Sets the job count of every host, the block size and the range size from the
+    calibration results. Every host runs one job per core (or its max_jobs, when lower
+    than that). A share of the work is never assigned up front: GNU parallel hands the
+    next block or range to whichever job slot is free first, so faster hosts pull more
+    of them and each host's share follows its actual throughput, including when it
+    changes during the run. The throughput of the slowest host sets the sizes, so its
+    workers finish a block in about BLOCK_SECONDS, or a range in about RANGE_SECONDS,
+    and do not hold up the end of the run.
+    Streamed blocks all leave the submitting host, so its uplink limits the run before
+    the workers do; with STAGED=1 the workers read their ranges on their own host.
+    
+    Arguments: 
+      - lines: 'host max_jobs cores MB/s' lines; max_jobs 0 means no limit
+      
+    Returns:
+      Prints the sshlogin for GNU parallel, the block size and the range size in bytes
+    """
+    hosts = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4 or not float(fields[3]):
+            print(f"[Warning] Calibration of {fields[0] if fields else 'a host'} failed, skipping it.", file=sys.stderr)
+            continue
+        host, max_jobs, cores, throughput = fields[0], int(fields[1]), int(fields[2]), float(fields[3])
+        hosts.append((host, min(cores, max_jobs) if max_jobs else cores, throughput))
+    if not hosts:
+        print("[Error] No host could be calibrated!", file=sys.stderr)
+        sys.exit(1)
+
+    for host, jobs, throughput in hosts:
+        print(f"[Status] {host}: {jobs} jobs at {throughput} MB/s each", file=sys.stderr)
+
+    slowest = min(throughput for _, _, throughput in hosts)
+    block = int(np.clip(slowest * 1e6 * BLOCK_SECONDS, *BLOCK_BOUNDS))
+    span = int(np.clip(slowest * 1e6 * RANGE_SECONDS, *RANGE_BOUNDS))
+    print(",".join(f"{jobs}/{host}" for host, jobs, _ in hosts), block, span)
+
+
 def process_qline():
     """
     Processes the quality line of a given fastq file. Data comes in from a bash file and
-    here we calculate the quality per base position. Thereafter, we 'dump' the data via
-    json back to the bash script for further handling.
+    here we calculate the sum and count of the quality scores per base position. These
+    are written as one binary record back to the bash script for further handling.
     
     Arguments: 
       X
       
     Returns:
-      Prints the quality score per base position in json format
+      Writes the sums and counts per base position as a binary record to stdout
     """
-    data = sys.stdin.buffer
-    phred_scores = defaultdict(list)
-    line_num = 0
-
-    with data as input_data:
-        for line in input_data:
-            line_num += 1
-            if line_num % 4 == 0:
-                qual = line.strip()
-                for pos, quality in enumerate(qual):
-                    phred_scores[pos].append(quality - 33)
-    # calculate the average per base position in place (for chunk)
-    print({key: np.mean(values) for key, values in phred_scores.items()})
+    with sys.stdin.buffer as input_data:
+        sums, counts = decode_windows(input_data.read())
+    write_totals(sums, counts, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
 
 
-def calculate_average(filename, *, outputfile="output.csv", multiple=False):
+def calculate_average(filename, *, outputfile="output.csv", multiple=False, metrics=None, cache=None, cache_key=None,
+                      started=None):
     """
     Calculates the average quality score per base position. Handles the results
     by writing it to a CSV or prints it back to the command line.
@@ -74,22 +360,58 @@ def calculate_average(filename, *, outputfile="output.csv", multiple=False):
       - filename: name of the fastq file
       - outputfile: name output file (CSV)
       - multiple: boolean whether determine if multiple fastq files need to be handled
+      - metrics: file to append the measurements of the workers and a record about
+                 the merge step to
+      - cache: ResultCache to store the sums and counts in under cache_key
+      - cache_key: fingerprint of the file, taken before it was read
+      - started: epoch time the pipeline of this file started; when given, prints a
+                 [Timings] line with read (starting the pipeline), parse (the workers
+                 reading and decoding the stream), reduce (adding the records) and write
       
     Returns:
       X
     """
-    data = sys.stdin.read().strip().split("\n")
-    #put back to a dict
-    result = [ast.literal_eval(res) for res in data]
-    combined_values = defaultdict(list)
+    measurements = []
+    merge_started = time.time()
+    reduce_seconds = 0.0
 
-    # combine into one defaultdict
-    for dictonary in result:
-      for key, value in dictonary.items():
-          combined_values[key].append(value)
-    
-    # calculate the averages for the whole file
-    averages = {key: np.mean(values) for key, values in combined_values.items()}
+    def merge():
+        nonlocal reduce_seconds
+        totals = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # add every record to the running totals as it comes in
+        for sub_totals in read_totals(sys.stdin.buffer, measurements):
+            before = time.time()
+            totals = add_totals(totals, sub_totals)
+            reduce_seconds += time.time() - before
+        return totals
+
+    (sums, counts), timings = measure(merge)
+    merge_ended = time.time()
+    if metrics:
+        write_metrics(metrics, measurements + [metrics_record("average", "parallel", os.environ.get("FILE_NAME"),
+                                                              **timings, positions=len(sums))])
+    if cache and cache_key:
+        cache.store(cache_key, (sums, counts))
+    write_averages(sums, counts, filename, outputfile=outputfile, multiple=multiple)
+    if started is not None:
+        end = time.time()
+        print(timings_line(merge_started - started, merge_ended - merge_started - reduce_seconds, reduce_seconds,
+                           end - merge_ended, end - started))
+
+
+def write_averages(sums, counts, filename, *, outputfile="output.csv", multiple=False):
+    """
+    Writes the average quality score per base position to a CSV, or prints it back
+    to the command line.
+
+    Arguments:
+      - sums, counts: int64 arrays per base position
+      - filename: name of the fastq file
+      - outputfile: name output file (CSV)
+      - multiple: boolean whether determine if multiple fastq files need to be handled
+    """
+    # weighted by the amount of reads per position, not by the amount of blocks
+    averages = {pos: sums[pos] / counts[pos] for pos in range(len(sums)) if counts[pos]}
 
     name_output = outputfile if not multiple else f"{filename}.{outputfile}"
     if filename is not None:
@@ -108,10 +430,31 @@ def main():
     args = parse_arguments()
     if args.calculate:
         process_qline()
+    if args.worker:
+        run_worker(measure_blocks=args.measure)
+    if args.range:
+        run_range(args.fastq_files[0], *args.range, measure_blocks=args.measure)
+    if args.ranges:
+        for fastq in args.fastq_files:
+            split_ranges(fastq, args.ranges)
+    if args.calibrate:
+        calibrate()
+    if args.schedule:
+        schedule(sys.stdin)
+    if args.fingerprint:
+        for fastq in args.fastq_files:
+            print(fingerprint(fastq))
+    cache = ResultCache(args.cache_dir, args.cache_size << 20) if args.cache_key else None
+    if args.lookup:
+        cached = cache.load(args.cache_key) if cache else None
+        if cached is None:
+            sys.exit(1)
+        write_averages(*cached, args.csvfile, multiple=args.n > 1)
     if args.merge:
         filename = args.csvfile if args.csvfile else None
         multiple = args.n > 1
-        calculate_average(filename=filename, multiple=multiple)
+        calculate_average(filename=filename, multiple=multiple, metrics=args.metrics,
+                          cache=cache, cache_key=args.cache_key, started=args.timings)
 
 if __name__ == "__main__":
     main()
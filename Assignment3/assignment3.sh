@@ -5,6 +5,14 @@
 # Usage: 
 #       first time only; chmod +x assignment3.sh
 #       ./assignment3.sh [fastq_file1] [fastq_file2] [fastq_fileN]
+#       HOSTS_FILE=<inventory> ./assignment3.sh [...] to use other hosts than hosts.txt
+#       METRICS=<file.jsonl> ./assignment3.sh [...] to record measurements of every block
+#       CACHE=1 ./assignment3.sh [...] to reuse the results of files that were processed before
+#                                      (stored in $BDC_CACHE, default ~/.cache/bdc)
+#       TIMINGS=1 ./assignment3.sh [...] to print the time per phase of every file as a [Timings] line
+#       STAGED=1 ./assignment3.sh [...] to let every host read its own byte ranges of uncompressed files
+#                                       that are at the same path on every host (e.g. on /commons)
+#       STAGED=copy ./assignment3.sh [...] the same, but first copy every file to the hosts with --basefile
 ##
 
 # user can specify their own fastq file, if not use the standard one
@@ -16,12 +24,92 @@ fi
 
 #count how many files if user decides to give more than one
 NUM_FILES=${#INPUT_FILES[@]}
-HOSTS="nuc100,nuc101"
 
 #export for parallel processes
 export WORK_DIR=$(realpath "$(dirname "$0")")
 
+# host inventory: one "host [max jobs]" per line
+HOSTS_FILE="${HOSTS_FILE:-${WORK_DIR}/hosts.txt}"
+
+# workers send their measurements along with their results, the merge step writes them all
+WORKER_ARGS=()
+METRICS_ARGS=()
+if [ -n "${METRICS}" ]; then
+  WORKER_ARGS=(--measure)
+  METRICS_ARGS=(--metrics "$(realpath "${METRICS}")")
+fi
+
+# a record starts with an '@' line followed by a sequence line; quality lines may also start with '@'
+RECSTART='@.*\n[A-Za-z]'
+
+# bgzip decompresses BGZF blocks on several threads and falls back to one thread for plain gzip
+if command -v bgzip > /dev/null; then
+  DECOMPRESS=(bgzip -dc -@ 4)
+else
+  DECOMPRESS=(gzip -dc)
+fi
+
+read_input() {
+  case "$1" in
+    *.gz)
+      # compressed files are streamed so decompression overlaps with the workers
+      "${DECOMPRESS[@]}" "$1"
+      ;;
+    *)
+      cat "$1"
+      ;;
+  esac
+}
+
+# calibration pass: every host decodes a sample of the first file on one core and reports
+# its cores and MB/s; the scheduler turns that into jobs per host, a block size and a range size
+SAMPLE=$(mktemp)
+trap 'rm -f "${SAMPLE}"' EXIT
+read_input "${INPUT_FILES[0]}" 2> /dev/null | head -c 4M > "${SAMPLE}"
+read -r SSHLOGIN BLOCK RANGE < <(
+  while read -r HOST MAX_JOBS; do
+    case "${HOST}" in ''|\#*) continue ;; esac
+    if [ "${HOST}" = ":" ]; then
+      RESULT=$(python3 "${WORK_DIR}"/assignment3.py --calibrate < "${SAMPLE}")
+    else
+      RESULT=$(ssh "${HOST}" python3 "${WORK_DIR}"/assignment3.py --calibrate < "${SAMPLE}")
+    fi
+    echo "${HOST} ${MAX_JOBS:-0} ${RESULT}"
+  done < "${HOSTS_FILE}" | python3 "${WORK_DIR}"/assignment3.py --schedule
+)
+[ -n "${SSHLOGIN}" ] || exit 1
+
 for INPUT_FILE in "${INPUT_FILES[@]}"; do
   export FILE_NAME=$(basename "$INPUT_FILE")
-  parallel -S "${HOSTS}" --pipepart --jobs 4 --block 10M --regex --recstart "@.*$" --recend "\n" python3 "${WORK_DIR}"/assignment3.py --calculate :::: "${INPUT_FILE}" | python3 "${WORK_DIR}"/assignment3.py --merge -o "${FILE_NAME}" -n "${NUM_FILES}"
+  TIMINGS_ARGS=()
+  if [ -n "${TIMINGS}" ]; then
+    TIMINGS_ARGS=(--timings "$(date +%s.%N)")
+  fi
+  # files found in the result cache are written right away and never read
+  CACHE_ARGS=()
+  if [ -n "${CACHE}" ]; then
+    CACHE_ARGS=(--cache-key "$(python3 "${WORK_DIR}"/assignment3.py --fingerprint "${INPUT_FILE}")")
+    if python3 "${WORK_DIR}"/assignment3.py --lookup -o "${FILE_NAME}" -n "${NUM_FILES}" "${CACHE_ARGS[@]}"; then
+      continue
+    fi
+  fi
+  MERGE=(python3 "${WORK_DIR}"/assignment3.py --merge -o "${FILE_NAME}" -n "${NUM_FILES}" "${METRICS_ARGS[@]}" "${CACHE_ARGS[@]}" "${TIMINGS_ARGS[@]}")
+  if [ -n "${STAGED}" ] && [[ "${INPUT_FILE}" != *.gz ]]; then
+    # every job maps its own record-aligned byte range of the file on its host, so only the
+    # ranges and the results cross the network; free job slots take the next range
+    INPUT_PATH=$(realpath "${INPUT_FILE}")
+    STAGE_ARGS=()
+    if [ "${STAGED}" = "copy" ]; then
+      STAGE_ARGS=(--basefile "${INPUT_PATH}")
+    fi
+    python3 "${WORK_DIR}"/assignment3.py --ranges "${RANGE}" "${INPUT_PATH}" | parallel -S "${SSHLOGIN}" "${STAGE_ARGS[@]}" --env FILE_NAME --colsep ' ' python3 "${WORK_DIR}"/assignment3.py --range {1} {2} "${WORKER_ARGS[@]}" "${INPUT_PATH}" | "${MERGE[@]}"
+    continue
+  fi
+  if [ -n "${STAGED}" ]; then
+    echo "[Warning] ${INPUT_FILE} is compressed and is streamed from this host." >&2
+  fi
+  # every host runs its calibrated amount of long-lived workers; --round-robin keeps writing blocks of
+  # whole records to the workers as fast as they take them, so faster hosts get a larger share.
+  # Every block leaves this host, so its uplink limits the run once the workers keep up with it
+  read_input "${INPUT_FILE}" | parallel -S "${SSHLOGIN}" --env FILE_NAME --pipe --round-robin --block "${BLOCK}" --regex --recstart "${RECSTART}" --recend "\n" python3 "${WORK_DIR}"/assignment3.py --worker "${WORKER_ARGS[@]}" | "${MERGE[@]}"
 done
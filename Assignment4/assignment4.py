@@ -18,6 +18,9 @@ import numpy as np
 from mpi4py import MPI
 
 from phred import PhredScoreCalculator
+# importing phred puts phredlib, at the root of the repository, on sys.path
+from phredlib import (CACHE_DIR, ResultCache, fingerprint, last_record_end, load_checkpoint, measure,
+                      metrics_record, store_checkpoint, write_metrics)
 
 def parse_arguments():
     """
@@ -26,7 +29,44 @@ def parse_arguments():
     parser = ap.ArgumentParser(description="Big data computing assignment 3 by Dennis Scheper")
     parser.add_argument("fastq_files", nargs='*', help="At least one Illumina Fastq Format file to process")
     parser.add_argument("-o", dest="csvfile", required=False, help="CSV file to store the output. Default is output to terminal STDOUT")
-    return parser.parse_args()
+    parser.add_argument("--totals", action="store_true", help="Return per-position sums and counts instead of every score, and combine them with a buffer-based MPI Reduce")
+    parser.add_argument("--index", action="store_true",
+                        help="Split on record count using a .fqi index of every --index-interval-th record")
+    parser.add_argument("--index-interval", type=int, default=1000,
+                        help="Amount of records between two offsets in the .fqi index (default 1000)")
+    parser.add_argument("--mpiio", action="store_true",
+                        help="Read the chunks with collective MPI-IO instead of every rank on its own (implies --totals)")
+    parser.add_argument("--aggregators", type=int, required=False,
+                        help="With --mpiio, use two-phase I/O with this many reading ranks")
+    parser.add_argument("--dynamic", action="store_true",
+                        help="Hand out --dynamic-chunks small chunks per rank on request from rank 0 (implies --totals)")
+    parser.add_argument("--dynamic-chunks", type=int, default=16,
+                        help="With --dynamic, amount of chunks per rank (default 16)")
+    parser.add_argument("--local", type=int, required=False,
+                        help="Hybrid mode: split the share of every rank over N local workers and merge it before the MPI reduce (implies --totals)")
+    parser.add_argument("--processes", action="store_true",
+                        help="With --local, use a process pool instead of NumPy threads")
+    parser.add_argument("--metrics", required=False,
+                        help="Append measurements of every chunk, gathered on rank 0, as JSON lines to this file")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse the sums and counts of a file that was processed before; no rank reads it then (implies --totals)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help=f"Directory of the result cache (default {CACHE_DIR}, or $BDC_CACHE)")
+    parser.add_argument("--cache-size", type=int, default=64,
+                        help="Size limit of the result cache in MB; least recently used files are removed first (default 64)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process the records appended since the checkpoint next to the file (implies --totals)")
+    args = parser.parse_args()
+    # every rank runs in one of these modes, so combining them would silently drop all but one
+    modes = [option for option, given in (("--mpiio", args.mpiio), ("--dynamic", args.dynamic),
+                                          ("--local", args.local)) if given]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} cannot be combined")
+    if args.aggregators and not args.mpiio:
+        parser.error("--aggregators only works with --mpiio")
+    if args.processes and not args.local:
+        parser.error("--processes only works with --local")
+    return args
 
 def main():
     """
@@ -38,22 +78,75 @@ def main():
     rank = comm.Get_rank()
     amount_processes = comm.Get_size()
 
-    calculator = PhredScoreCalculator(args.fastq_files[0], amount_processes)
-
-    if rank == 0:
-        calculator.make_chuncks()
+    amount_chunks = amount_processes * (args.dynamic_chunks if args.dynamic else args.local or 1)
+    calculator = PhredScoreCalculator(args.fastq_files[0], amount_chunks,
+                                      totals=args.totals or args.mpiio or args.cache or args.incremental
+                                      or bool(args.dynamic or args.local),
+                                      index_interval=args.index_interval if args.index else None,
+                                      metrics=bool(args.metrics))
+
+    # rank 0 looks the file up in the result cache; on a hit no rank reads it
+    cache = ResultCache(args.cache_dir, args.cache_size << 20) if args.cache and rank == 0 else None
+    key = fingerprint(calculator.fastq) if cache else None
+    cached = cache.load(key) if cache else None
+
+    # rank 0 continues from the checkpoint of the last run, so the ranks only get the new records
+    checkpoint = None
+    if args.incremental and rank == 0 and calculator.compression is None:
+        offset, checkpoint = load_checkpoint(calculator.fastq)
+        calculator.span = (offset, last_record_end(calculator.fastq, offset))
+        if cached is None and offset == calculator.span[1]:
+            cached = checkpoint
+    if comm.bcast(cached is not None, root=0):
+        if rank == 0:
+            for pos, score in calculator.calculate_average([[cached]]).items():
+                print(f"{pos},{score}")
+        return
+
+    if rank == 0 and calculator.compression != "gzip":
+        _, timings = measure(calculator.make_chuncks)
+        if args.metrics:
+            calculator.records.append(metrics_record("split", "mpi", calculator.fastq, **timings,
+                                                     chuncks=len(calculator.chuncks)))
         chunks = calculator.get_chunks()
         array_chunks = np.array_split(chunks, amount_processes)
     else:
         array_chunks = None
 
-    scatter_chunks = comm.scatter(array_chunks, root=0)
-    res = [calculator.process_chunck(chunk) for chunk in scatter_chunks]
-
-    all_processed_chunks = comm.gather(res, root=0)
+    if calculator.compression == "gzip":
+        res = calculator.process_stream(rank, amount_processes)
+    elif args.dynamic:
+        res = calculator.process_dynamic(comm)
+    else:
+        scatter_chunks = comm.scatter(array_chunks, root=0)
+        if args.mpiio and calculator.compression is None:
+            res = calculator.read_collective(comm, scatter_chunks, aggregators=args.aggregators)
+        elif args.local:
+            res = calculator.process_local(scatter_chunks, args.local, threads=not args.processes)
+        else:
+            res = [calculator.process_chunck(chunk) for chunk in scatter_chunks]
+
+    if calculator.totals:
+        # fixed-size buffers of a few kilobytes per rank instead of pickled Python objects
+        totals = calculator.reduce_totals(comm, calculator.merge_totals(res))
+        if checkpoint is not None:
+            totals = calculator.merge_totals([checkpoint, totals])
+        all_processed_chunks = [[totals]]
+        if calculator.span:
+            store_checkpoint(calculator.fastq, calculator.span[1], totals)
+        elif cache:
+            # a growing file would be cached without its last, half written record
+            cache.store(key, totals)
+    else:
+        all_processed_chunks = comm.gather(res, root=0)
+    # every rank kept its own records; they are small, so pickling them is fine
+    records = comm.gather(calculator.records, root=0) if args.metrics else None
 
     if rank == 0:
-        averages = calculator.calculate_average(all_processed_chunks)
+        averages, timings = measure(calculator.calculate_average, all_processed_chunks)
+        if args.metrics:
+            write_metrics(args.metrics, [record for rank_records in records for record in rank_records]
+                          + [metrics_record("average", "mpi", calculator.fastq, **timings, positions=len(averages))])
 
         for pos, score in averages.items():
             print(f"{pos},{score}")
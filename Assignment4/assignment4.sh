@@ -26,4 +26,10 @@ export WORK_DIR=$(realpath "$(dirname "$0")")
 
 source /commons/conda/conda_load.sh
 
-mpirun -np 5 python3 assignment4.py "${INPUT_FILES}"
+# HYBRID=1 runs one rank per node that spreads its share over a local thread pool with one
+# thread per cpu, e.g. sbatch --ntasks-per-node=1 --cpus-per-task=5 assignment4.sh
+if [ -n "${HYBRID}" ]; then
+  mpirun -np "${SLURM_NNODES:-1}" --map-by ppr:1:node python3 assignment4.py "${INPUT_FILES}" --local "${SLURM_CPUS_PER_TASK:-5}"
+else
+  mpirun -np 5 python3 assignment4.py "${INPUT_FILES}"
+fi
@@ -16,16 +16,7 @@ fi
 export WORK_DIR=$(realpath "$(dirname "$0")")
 
 
-RESULT_FILE="${WORK_DIR}/timing.csv"
-echo "worker_repeat,time" > "${RESULT_FILE}" #header
-
-for worker in {3..5}; do #minimal 2 since we want to have 1 controller at all times
-  FILE_PATH="data/worker_${worker}"
-  mkdir -p ${FILE_PATH} #make directory, -p since we don't want errors if the directory already exists
-  for repeat in {1..3}; do
-    echo "${worker} on ${repeat}"
-    output="output_${worker}_${repeat}.csv"
-    run_time=$(mpirun -np $worker python3 "${WORK_DIR}"/deliverable2.py "${INPUT_FILES}" -o ${WORK_DIR}/${FILE_PATH}/${output}) #save in var to write to csv with echo command
-    echo "${worker}_${repeat},${run_time}" >> "${RESULT_FILE}"
-  done
-done
+# benchmark.py runs every worker count with a warm-up run and 3 measured repeats, keeps the CSVs
+# under data/worker_<n>/ and writes the timings per phase, speedup and efficiency as JSON lines
+python3 "${WORK_DIR}"/../benchmark.py --backends mpi --workers 1 2 3 4 5 --repeat 3 --warmup 1 \
+  --keep-output "${WORK_DIR}/data" -o "${WORK_DIR}/data/timings.jsonl" "${INPUT_FILES}"
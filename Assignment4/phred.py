@@ -13,9 +13,23 @@ __date__ = "17/05/2024"
 __contact__ = "d.j.scheper@st.hanze.nl"
 
 import csv
+import multiprocessing as mp
 import os
+import sys
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+from mpi4py import MPI
+
+# the shared helpers live in phredlib.py at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from phredlib import (DECODE_WINDOW, align_to_record, bgzf_blocks, chunck_metrics, decode_qualities,
+                      decode_windows, detect_compression, inflate_bgzf, load_index, map_chunck, measure,
+                      metrics_record, pad_totals, stream_gzip)
+
+# message tags of the dynamic master/worker mode
+TAG_REQUEST = 1
+TAG_WORK = 2
 
 
 class PhredScoreCalculator:
@@ -23,32 +37,63 @@ class PhredScoreCalculator:
     Class used to handle the processing of a FastQ file to Phred scores.
 
     Functions:
-    - make_chuncks: splits FastQ file into chuncks in bytes based on the amount of cores
+    - make_chuncks: splits FastQ file into record-aligned chuncks based on the amount of cores
     - get_chuncks: simply retrieve all chuncks
     - process_file: this function calculates the Phred score per base position per chunck
+    - process_stream: decodes this rank's share of a plain gzip file
     - calculate_average: calculates the average Phred score per base position by concatenating
                          all chuncks into defaultdict
+    - merge_totals: adds the per-position sums and counts of all chuncks together
+    - reduce_totals: adds the sums and counts of every rank together with buffer-based MPI
+    - read_collective: loads and decodes the chuncks of every rank with collective MPI-IO
+    - process_dynamic: hands chuncks out on request, rank 0 works on them in between
+    - process_local: splits the chuncks of a rank over a local pool and merges them in the node
+    - measured: decodes a chunck and keeps a --metrics record of it
     - write_csv: used for writing the results to a CSV format
     """
 
-    def __init__(self, fastq, n):
+    def __init__(self, fastq, n, *, totals=False, index_interval=None, metrics=False, span=None):
         """
         Initiator. 
 
         args:
         - fastq: FastQ file to be processed
         - n: amount of cores
+        - totals: when True, every chunck is memory-mapped and decoded by the vectorized
+                  decode_qualities kernel, and returns fixed-size per-position sums and
+                  counts instead of a list of every single score. Always on for
+                  gzip/BGZF compressed files
+        - index_interval: when given, split on record count using a .fqi sidecar
+                          holding the offset of every index_interval-th record
+        - metrics: when True, every chunck this rank decodes is measured
+        - span: (start, end) byte range of whole records to split instead of the whole
+                file, for --incremental; only used for uncompressed files, and goes
+                before the .fqi index, which would have to be rebuilt on every run
 
         self.chuncks: holds the chuncks defined by the make_chuncks function
+        self.records: --metrics records of the chuncks this rank decoded
+        self.rank: rank of this process for the --metrics records, taken here because the
+                   forked workers of process_local must not make MPI calls of their own
         """
         self.fastq = fastq
         self.n = n
+        self.compression = detect_compression(self.fastq)
+        self.totals = totals or self.compression is not None
+        self.index_interval = index_interval
+        self.metrics = metrics
+        self.span = span
         self.chuncks = []
+        self.records = []
+        self.rank = MPI.COMM_WORLD.Get_rank()
 
     def make_chuncks(self):
         """
         Determines how large a chunck is by calculating its start and end positions in bytes.
         The amount of chuncks is equal to the number of cores given by the user.
+        Every split point is snapped to the start of a record, or taken from the .fqi index
+        so every chunck holds the same amount of records. BGZF files are split on block
+        boundaries in compressed bytes, plain gzip files can only be one chunck.
+        With a span, only that range of an uncompressed file is split, on record starts.
         All start and end positions are appended to self.chuncks for easy access within the class.
         """
         try:
@@ -56,11 +101,28 @@ class PhredScoreCalculator:
         except FileNotFoundError as err:
             print(f"{err}: File in question has not been found. Are you sure it exists?")
 
-        chunck_size = file_size // self.n
+        start, end = self.span if self.span and not self.compression else (0, file_size)
+        chunck_size = (end - start) // self.n
+
+        if self.compression == "bgzf":
+            blocks = bgzf_blocks(self.fastq)
+            starts = np.searchsorted(blocks, np.arange(self.n) * chunck_size)
+            bounds = [int(bound) for bound in np.append(blocks, file_size)[starts]]
+        elif self.compression == "gzip":
+            bounds = [0]
+        elif self.span:
+            with open(self.fastq, 'rb') as inputfile:
+                bounds = [start] + [min(align_to_record(inputfile, start + i * chunck_size), end)
+                                    for i in range(1, self.n)]
+        elif self.index_interval:
+            offsets = load_index(self.fastq, self.index_interval)
+            bounds = [int(offsets[(i * len(offsets)) // self.n]) for i in range(self.n)]
+        else:
+            with open(self.fastq, 'rb') as inputfile:
+                bounds = [align_to_record(inputfile, i * chunck_size) for i in range(self.n)]
+        bounds.append(end)
 
-        for i in range(self.n):
-            start = i * chunck_size
-            end = start + chunck_size if i < self.n - 1 else file_size
+        for start, end in zip(bounds, bounds[1:]):
             self.chuncks.append((start, end))
 
 
@@ -73,12 +135,44 @@ class PhredScoreCalculator:
 
     def process_chunck(self, start_end):
         """
+        Decodes one chunck through measured, so a record of it is kept when
+        --metrics is used.
+
+        args:
+        - start_end: (start, end) byte positions of the chunck
+
+        returns:
+        - the result of decode_chunck
         """
         start, end = start_end
+        return self.measured(self.decode_chunck, (int(start), int(end)), start_end)
+
+    def decode_chunck(self, start_end):
+        """
+        Reads one chunck and collects its Phred scores per base position. BGZF
+        blocks are inflated, plain gzip files are streamed as a whole, and in
+        totals mode uncompressed chuncks are memory-mapped; all of those are
+        decoded with the vectorized kernel.
+
+        args:
+        - start_end: (start, end) byte positions of the chunck
+
+        returns:
+        - defaultdict with a list of Phred scores per base position, or a
+          (sums, counts) tuple of int64 arrays in totals mode
+        """
+        start, end = start_end
+        if self.compression == "bgzf":
+            return decode_windows(inflate_bgzf(self.fastq, start, end))
+        if self.compression == "gzip":
+            return self.merge_totals([decode_qualities(piece) for piece in stream_gzip(self.fastq)])
+        if self.totals:
+            return decode_windows(map_chunck(self.fastq, start, end))
+
         with open(self.fastq, 'rb') as inputfile:
             inputfile.seek(start)
             chunk = inputfile.read(end-start)
-        
+
         lines = chunk.split(b"\n")
         line_num = 0
         num_dict = defaultdict(list)
@@ -91,6 +185,22 @@ class PhredScoreCalculator:
         
         return num_dict
 
+    def process_stream(self, rank, size):
+        """
+        Plain gzip files cannot be split, so every rank decompresses the whole
+        stream but only decodes every size-th record-aligned piece. Nothing has
+        to be sent between ranks and memory stays at one piece per rank.
+
+        args:
+        - rank: rank of this process
+        - size: amount of processes
+
+        returns:
+        - list of (sums, counts) tuples for the pieces of this rank
+        """
+        return [self.measured(decode_qualities, piece, piece) for i, piece in enumerate(stream_gzip(self.fastq))
+                if i % size == rank]
+
     def calculate_average(self, phred_scores):
         """
         Calculates the average Phred score per base position by first merging
@@ -102,6 +212,10 @@ class PhredScoreCalculator:
         returns:
         - a defaultdict with the average phred score per base position
         """
+        if self.totals:
+            sums, counts = self.merge_totals([totals for d in phred_scores for totals in d])
+            return {pos: sums[pos] / counts[pos] for pos in range(len(sums)) if counts[pos]}
+
         result = defaultdict(list)
 
         # Assuming each d in all_processed_chunks is a dictionary of lists
@@ -113,7 +227,197 @@ class PhredScoreCalculator:
         # then simply return the mean per base position
         return {key: np.mean(values) for key, values in result.items()}
 
-    
+    def merge_totals(self, totals):
+        """
+        Adds the per-position sums and counts of every chunck together. Chuncks
+        can hold reads of different lengths, so shorter arrays are padded first.
+
+        args:
+        - totals: list of (sums, counts) tuples
+
+        returns:
+        - one (sums, counts) tuple sized to the longest read
+        """
+        length = max((len(sums) for sums, _ in totals), default=0)
+        sums = np.zeros(length, dtype=np.int64)
+        counts = np.zeros(length, dtype=np.int64)
+
+        for sub_sums, sub_counts in totals:
+            sums[:len(sub_sums)] += sub_sums
+            counts[:len(sub_counts)] += sub_counts
+
+        return sums, counts
+
+    def reduce_totals(self, comm, totals, root=0):
+        """
+        Adds the per-position sums and counts of every rank together. The ranks first
+        agree on the longest read with Allreduce(MAX), so all of them send equally sized
+        int64 buffers to the uppercase Reduce; nothing is pickled and every rank sends
+        16 bytes per base position.
+
+        args:
+        - comm: MPI communicator
+        - totals: (sums, counts) tuple of this rank
+        - root: rank that receives the result
+
+        returns:
+        - the (sums, counts) tuple of all ranks on root, None on the other ranks
+        """
+        length = np.array([len(totals[0])], dtype=np.int64)
+        comm.Allreduce(MPI.IN_PLACE, length, op=MPI.MAX)
+        send = np.stack(pad_totals(totals, int(length[0])))
+        recv = np.empty_like(send) if comm.Get_rank() == root else None
+        comm.Reduce(send, recv, op=MPI.SUM, root=root)
+        return None if recv is None else (recv[0], recv[1])
+
+    def read_collective(self, comm, chuncks, *, aggregators=None, block=DECODE_WINDOW):
+        """
+        Loads the record-aligned chuncks of this rank with collective MPI-IO, so the
+        MPI library sees the reads of all ranks at once instead of every rank seeking
+        on its own. Chuncks are read in pieces of at most block bytes; every piece is
+        cut after a multiple of four newlines and the rest carries over to the next.
+        Ranks with fewer pieces join the remaining collective calls with empty reads.
+        Pieces are decoded with decode_windows, so a larger block only costs the read
+        buffer and not a multiple of it in decode_qualities.
+
+        args:
+        - comm: MPI communicator, every rank has to call this function
+        - chuncks: (start, end) tuples of this rank
+        - aggregators: when given, use two-phase I/O where this many ranks read large
+                       contiguous stripes and hand the data on to the others
+        - block: maximum amount of bytes per rank per collective read
+
+        returns:
+        - list of (sums, counts) tuples, one per piece
+        """
+        pieces = [(int(offset), int(min(block, end - offset)), offset + block >= end)
+                  for start, end in chuncks for offset in range(int(start), int(end), block)]
+        rounds = comm.allreduce(len(pieces), op=MPI.MAX)
+
+        info = MPI.Info.Create()
+        if aggregators:
+            info.Set("romio_cb_read", "enable")
+            info.Set("cb_nodes", str(aggregators))
+        inputfile = MPI.File.Open(comm, self.fastq, MPI.MODE_RDONLY, info)
+
+        totals = []
+        rest = np.zeros(0, dtype=np.uint8)
+        try:
+            for i in range(rounds):
+                offset, size, last = pieces[i] if i < len(pieces) else (0, 0, True)
+                piece = np.empty(size, dtype=np.uint8)
+                _, read = measure(inputfile.Read_at_all, offset, piece)
+                data = np.concatenate((rest, piece)) if len(rest) else piece
+
+                newlines = np.flatnonzero(data == ord("\n"))
+                cut = len(data) if last else (newlines[4 * (len(newlines) // 4) - 1] + 1 if len(newlines) >= 4 else 0)
+                start = offset + size - len(data)
+                totals.append(self.measured(decode_windows, (start, start + int(cut)), data[:cut], read=read))
+                rest = data[cut:]
+        finally:
+            inputfile.Close()
+            info.Free()
+        return totals
+
+    def process_dynamic(self, comm):
+        """
+        Work queue over point-to-point messages. Rank 0 holds many small chuncks and
+        sends one to every rank that asks for one, so faster ranks process more of
+        them; whenever no request is waiting, rank 0 processes a chunck itself. Every
+        other rank asks for its next chunck before it starts on the current one, so
+        it never waits for rank 0 to finish a chunck of its own. Chuncks are sent as
+        int64 (start, end) buffers, (-1, -1) means there is no work left.
+
+        args:
+        - comm: MPI communicator; rank 0 must have run make_chuncks
+
+        returns:
+        - list of (sums, counts) tuples of the chuncks this rank processed
+        """
+        request = np.empty(0, dtype=np.int64)
+        job = np.empty(2, dtype=np.int64)
+        totals = []
+
+        if comm.Get_rank() == 0:
+            chuncks = list(reversed(self.chuncks))
+            status = MPI.Status()
+            stopped = 0
+            while chuncks or stopped < comm.Get_size() - 1:
+                if chuncks and not comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_REQUEST):
+                    totals.append(self.process_chunck(chuncks.pop()))
+                    continue
+                comm.Recv(request, source=MPI.ANY_SOURCE, tag=TAG_REQUEST, status=status)
+                job[:] = chuncks.pop() if chuncks else (-1, -1)
+                stopped += job[0] < 0
+                comm.Send(job, dest=status.Get_source(), tag=TAG_WORK)
+            return totals
+
+        comm.Send(request, dest=0, tag=TAG_REQUEST)
+        comm.Recv(job, source=0, tag=TAG_WORK)
+        while job[0] >= 0:
+            start, end = job
+            comm.Send(request, dest=0, tag=TAG_REQUEST)
+            totals.append(self.process_chunck((int(start), int(end))))
+            comm.Recv(job, source=0, tag=TAG_WORK)
+        return totals
+
+    def process_local(self, chuncks, workers, *, threads=True):
+        """
+        Hybrid execution with one rank per node: the chuncks of this rank are spread over
+        a local pool and merged inside the node, so only one sums/counts buffer per node
+        takes part in the MPI reduction. The decode kernel spends most of its time in
+        NumPy calls that release the GIL, so threads are the default; forked processes
+        are used otherwise, as they do not make MPI calls of their own.
+
+        args:
+        - chuncks: (start, end) tuples of this rank
+        - workers: size of the local pool
+        - threads: use a thread pool instead of a process pool
+
+        returns:
+        - list with the merged (sums, counts) tuple of this rank
+        """
+        if threads:
+            with ThreadPoolExecutor(workers) as pool:
+                return [self.merge_totals(list(pool.map(self.process_chunck, chuncks)))]
+
+        with ProcessPoolExecutor(workers, mp_context=mp.get_context("fork")) as pool:
+            results = list(pool.map(self.collect_chunck, chuncks))
+        self.records += [record for _, records in results for record in records]
+        return [self.merge_totals([totals for totals, _ in results])]
+
+    def collect_chunck(self, start_end):
+        """
+        process_chunck for forked workers: their --metrics records would stay behind
+        in the child, so they are returned together with the result.
+
+        returns:
+        - ((sums, counts) tuple, list of --metrics records)
+        """
+        self.records = []
+        return self.process_chunck(start_end), self.records
+
+    def measured(self, function, chunck, *args, read=None):
+        """
+        Runs function(*args); with metrics on, keeps a record of it in self.records.
+
+        args:
+        - function: decoding function
+        - chunck: (start, end) tuple or the bytes the record describes
+        - read: timings of reading the chunck beforehand, added to the record
+
+        returns:
+        - the result of function
+        """
+        if not self.metrics:
+            return function(*args)
+        result, timings = measure(function, *args)
+        for key in ("wall_seconds", "cpu_seconds", "io_wait_seconds") if read else ():
+            timings[key] += read[key]
+        self.records.append(metrics_record("chunck", "mpi", self.fastq, rank=self.rank,
+                                           **timings, **chunck_metrics(chunck, result)))
+        return result
+
     def csv_writer(self, phred_scores, *, outputfile="output.csv", multiple=False):
         """
         Writes the result to a csv specified by the user.
@@ -128,8 +432,9 @@ class PhredScoreCalculator:
         - average phred score per base position in CSV format
         """
         filename = os.path.basename(self.fastq) # get name of fastq file
-        name_output = outputfile if not multiple else f"{filename}.{outputfile}.csv"
-        with open(name_output.name, 'w', newline='', encoding='UTF-8') as csv_file:
+        directory, name = os.path.split(getattr(outputfile, "name", outputfile))
+        name_output = os.path.join(directory, name if not multiple else f"{filename}.{name}")
+        with open(name_output, 'w', newline='', encoding='UTF-8') as csv_file:
             writer = csv.writer(csv_file)
             for key, value in phred_scores.items():
                 writer.writerow([key, value])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""Big Data Computing (BDC) scaling benchmark.
+
+Runs the Phred score backends of the assignments over a grid of worker counts and
+input files. Every configuration gets warm-up runs and repeated measurements; one
+JSON line is written per run, and one summary line per configuration with the
+median time, speedup and parallel efficiency. Every backend runs in totals mode,
+keeping per-position sums and counts, so they do the same work, and reports its
+phases (read, parse, reduce, write) on a "[Timings] {...}" line that is recorded too.
+
+Speedup and efficiency are relative to the smallest worker count in the grid,
+assuming it scaled perfectly up to there:
+    speedup = median(smallest) / median(workers) * smallest
+    efficiency = speedup / workers
+
+Usage:
+    python3 benchmark.py --backends pool mpi --workers 1 2 4 [--repeat 3] [--warmup 1] [-o results.jsonl] rnaseqfile.fastq [...]
+    python3 benchmark.py ... --baseline previous.jsonl [--tolerance 0.1]
+"""
+
+__author__ = "Dennis Scheper"
+__status__ = "Production"
+__version__ = "v1.0"
+__date__ = "30/06/2024"
+__contact__ = "d.j.scheper@st.hanze.nl"
+
+import argparse as ap
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+TIMINGS_PREFIX = "[Timings] "
+PHASES = ("read", "parse", "reduce", "write")
+
+
+def parse_arguments():
+    """
+    Defines command-line arguments.
+    """
+    parser = ap.ArgumentParser(description="Scaling benchmark for the Big Data Computing assignments")
+    parser.add_argument("fastq_files", nargs='+', help="Input files, for example of different sizes")
+    parser.add_argument("--backends", nargs='+', choices=sorted(BACKENDS), default=["pool"],
+                        help="Backends to run: pool (assignment1), network (assignment2), parallel (assignment3), mpi (assignment4)")
+    parser.add_argument("--workers", nargs='+', type=int, default=[1, 2, 4], help="Worker counts to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Measured runs per configuration")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs per configuration")
+    parser.add_argument("--mpirun-args", default="", help="Extra arguments for mpirun, for example --oversubscribe")
+    parser.add_argument("-o", dest="output", type=ap.FileType('w', encoding='UTF-8'), default=sys.stdout,
+                        help="JSON lines file for the results. Default is output to terminal STDOUT")
+    parser.add_argument("--keep-output", help="Keep the CSV of every run as <dir>/worker_<n>/output_<n>_<repeat>.csv")
+    parser.add_argument("--baseline", type=ap.FileType('r', encoding='UTF-8'),
+                        help="Results of an earlier benchmark; exit with 1 when the efficiency dropped")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative drop in efficiency compared to --baseline (default 0.1)")
+    return parser.parse_args()
+
+
+def free_port():
+    """
+    returns:
+    - a TCP port that is free on this machine
+    """
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    """
+    Waits until a server listens on the given port, or its process stopped.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+
+
+def run_pool(workers, fastq, workdir, args):
+    """
+    Assignment 1: one multiprocessing pool, reporting its phases.
+
+    returns:
+    - (stdout, path of the output csv)
+    """
+    output = os.path.join(workdir, "output.csv")
+    command = [sys.executable, os.path.join(ROOT, "Assignment1", "assignment1.py"),
+               "-n", str(workers), "--totals", "--timings", "-o", output, fastq]
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout, output
+
+
+def run_network(workers, fastq, workdir, args):
+    """
+    Assignment 2: a server and one client with the given amount of peons on this machine;
+    the server reports the phases.
+
+    returns:
+    - (stdout, path of the output csv)
+    """
+    output = os.path.join(workdir, "output.csv")
+    port = str(free_port())
+    script = os.path.join(ROOT, "Assignment2", "assignment2.py")
+    server = subprocess.Popen([sys.executable, script, "-s", fastq, "--host", "localhost", "--port", port,
+                               "--chunks", str(4 * workers), "--timings", "-o", output],
+                              cwd=os.path.dirname(script), stdout=subprocess.PIPE, text=True)
+    wait_for_port(int(port), server)
+    client = subprocess.Popen([sys.executable, script, "-c", "--host", "localhost", "--port", port,
+                               "-n", str(workers)], cwd=os.path.dirname(script), stdout=subprocess.DEVNULL)
+    stdout, _ = server.communicate()
+    client.wait()
+    if server.returncode:
+        raise subprocess.CalledProcessError(server.returncode, server.args)
+    return stdout, output
+
+
+def run_parallel(workers, fastq, workdir, args):
+    """
+    Assignment 3: the GNU parallel pipeline with the given amount of local jobs; the
+    merge step reports the phases.
+
+    returns:
+    - (stdout, path of the output csv)
+    """
+    hosts = os.path.join(workdir, "hosts.txt")
+    with open(hosts, 'w', encoding='UTF-8') as hosts_file:
+        hosts_file.write(f": {workers}\n")
+    command = ["bash", os.path.join(ROOT, "Assignment3", "assignment3.sh"), fastq]
+    stdout = subprocess.run(command, cwd=workdir, env={**os.environ, "HOSTS_FILE": hosts, "TIMINGS": "1"},
+                            capture_output=True, text=True, check=True).stdout
+    return stdout, os.path.join(workdir, "output.csv")
+
+
+def run_mpi(workers, fastq, workdir, args):
+    """
+    Assignment 4: mpirun with the given amount of ranks, reporting its phases.
+
+    returns:
+    - (stdout, path of the output csv)
+    """
+    output = os.path.join(workdir, "output.csv")
+    command = ["mpirun", *args.mpirun_args.split(), "-np", str(workers), sys.executable,
+               os.path.join(ROOT, "Assignment4", "deliverable2.py"), fastq, "--totals", "-o", output]
+    return subprocess.run(command, cwd=os.path.join(ROOT, "Assignment4"), capture_output=True,
+                          text=True, check=True).stdout, output
+
+
+BACKENDS = {"pool": run_pool, "network": run_network, "parallel": run_parallel, "mpi": run_mpi}
+
+
+def measure(backend, workers, fastq, args):
+    """
+    Runs a backend once in a fresh working directory.
+
+    returns:
+    - (wall-clock seconds, dict with the phases it reported, path of a copy of the output csv)
+    """
+    workdir = tempfile.mkdtemp(prefix="bdc_benchmark_")
+    try:
+        start = time.perf_counter()
+        stdout, output = BACKENDS[backend](workers, fastq, workdir, args)
+        seconds = time.perf_counter() - start
+        phases = {}
+        for line in stdout.splitlines():
+            if line.startswith(TIMINGS_PREFIX):
+                phases = json.loads(line[len(TIMINGS_PREFIX):])
+        kept = None
+        if os.path.exists(output):
+            kept = f"{workdir}.csv"
+            shutil.move(output, kept)
+        return seconds, {phase: phases[phase] for phase in PHASES if phase in phases}, kept
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def keep_output(args, backend, fastq, workers, repeat, csv_file):
+    """
+    Moves the output of a run into --keep-output, or removes it.
+    """
+    if csv_file is None:
+        return
+    if not args.keep_output:
+        os.remove(csv_file)
+        return
+    # extra levels only when several backends or inputs would otherwise overwrite each other
+    levels = [backend, os.path.basename(fastq)] if len(args.backends) > 1 or len(args.fastq_files) > 1 else []
+    directory = os.path.join(args.keep_output, *levels, f"worker_{workers}")
+    os.makedirs(directory, exist_ok=True)
+    shutil.move(csv_file, os.path.join(directory, f"output_{workers}_{repeat}.csv"))
+
+
+def summarize(runs):
+    """
+    Sums up the runs of one backend and input over all worker counts.
+
+    args:
+    - runs: dict of worker count to a list of (seconds, phases) tuples
+
+    returns:
+    - list of summary dicts, sorted by worker count
+    """
+    smallest = min(runs)
+    reference = statistics.median(seconds for seconds, _ in runs[smallest])
+    summaries = []
+    for workers in sorted(runs):
+        times = [seconds for seconds, _ in runs[workers]]
+        median = statistics.median(times)
+        speedup = reference / median * smallest
+        phases = {phase: statistics.median(found[phase] for _, found in runs[workers])
+                  for phase in PHASES if all(phase in found for _, found in runs[workers])}
+        summaries.append({"workers": workers, "median": median, "min": min(times),
+                          "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+                          "speedup": speedup, "efficiency": speedup / workers, "phases": phases})
+    return summaries
+
+
+def check_baseline(summaries, baseline, tolerance):
+    """
+    Compares the efficiency of every configuration with an earlier benchmark.
+
+    returns:
+    - list of warnings for configurations whose efficiency dropped more than tolerance
+    """
+    previous = {}
+    for line in baseline:
+        record = json.loads(line)
+        if record.get("type") == "summary":
+            previous[(record["backend"], record["input"], record["workers"])] = record["efficiency"]
+
+    warnings = []
+    for record in summaries:
+        key = (record["backend"], record["input"], record["workers"])
+        if key in previous and record["efficiency"] < previous[key] * (1 - tolerance):
+            warnings.append(f"{key[0]} on {key[1]} with {key[2]} workers: efficiency "
+                            f"{record['efficiency']:.2f}, was {previous[key]:.2f}")
+    return warnings
+
+
+def main():
+    """
+    Main function; runs the whole grid and writes the results.
+    """
+    args = parse_arguments()
+    summaries = []
+
+    for backend in args.backends:
+        for fastq in args.fastq_files:
+            fastq = os.path.realpath(fastq)
+            base = {"backend": backend, "input": os.path.basename(fastq), "bytes": os.path.getsize(fastq)}
+            runs = {}
+            for workers in args.workers:
+                for _ in range(args.warmup):
+                    csv_file = measure(backend, workers, fastq, args)[2]
+                    if csv_file:
+                        os.remove(csv_file)
+                runs[workers] = []
+                for repeat in range(1, args.repeat + 1):
+                    seconds, phases, csv_file = measure(backend, workers, fastq, args)
+                    keep_output(args, backend, fastq, workers, repeat, csv_file)
+                    runs[workers].append((seconds, phases))
+                    print(json.dumps({"type": "run", **base, "workers": workers, "repeat": repeat,
+                                      "seconds": seconds, "phases": phases}), file=args.output, flush=True)
+                print(f"[Status] {backend} on {base['input']} with {workers} workers done.", file=sys.stderr)
+
+            for summary in summarize(runs):
+                summaries.append({"type": "summary", **base, **summary})
+                print(json.dumps(summaries[-1]), file=args.output, flush=True)
+
+    if args.baseline:
+        warnings = check_baseline(summaries, args.baseline, args.tolerance)
+        for warning in warnings:
+            print(f"[Warning] Scaling regression: {warning}", file=sys.stderr)
+        if warnings:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
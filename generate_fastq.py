@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""Big Data Computing (BDC) synthetic FastQ generator.
+
+Writes reproducible FastQ files of a given size, so the assignments can be tested and
+benchmarked without the files on the original cluster. The same seed always gives the
+same reads, and a smaller file with the same settings is a prefix of a larger one.
+Reads are generated and written in batches, so memory stays flat for any size.
+
+Usage:
+    python3 generate_fastq.py --size 2G [--seed 42] [--length normal:100:10] [--profile illumina]
+                              [--paired] [--compress gzip|bgzf] [--at-quality 0.05] output.fastq
+"""
+
+__author__ = "Dennis Scheper"
+__status__ = "Production"
+__version__ = "v1.0"
+__date__ = "30/06/2024"
+__contact__ = "d.j.scheper@st.hanze.nl"
+
+import argparse as ap
+import gzip
+import os
+import re
+import struct
+import sys
+import zlib
+from statistics import NormalDist
+import numpy as np
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# reads per batch; fixed so the output does not depend on --size
+BATCH = 1 << 14
+# uncompressed bytes per BGZF block, as bgzip uses
+BGZF_BLOCK = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text):
+    """
+    Parses a size such as 500M or 2G.
+
+    returns:
+    - the size in bytes
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", text.strip().upper())
+    if not match:
+        raise ap.ArgumentTypeError(f"invalid size: {text}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def parse_arguments():
+    """
+    Defines command-line arguments.
+    """
+    parser = ap.ArgumentParser(description="Synthetic FastQ generator voor Big Data Computing")
+    parser.add_argument("output", help="FastQ file to write; with --paired _1 and _2 are added to the name")
+    parser.add_argument("--size", type=parse_size, required=True,
+                        help="Uncompressed size per file, e.g. 500M or 2G; the last record is kept whole")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random generator (default 42)")
+    parser.add_argument("--length", default="fixed:100",
+                        help="Read length distribution: fixed:N, uniform:MIN:MAX or normal:MEAN:SD (default fixed:100)")
+    parser.add_argument("--profile", default="illumina",
+                        help="Quality profile: illumina (drops towards the 3' end), flat:Q or uniform:MIN:MAX (default illumina)")
+    parser.add_argument("--paired", action="store_true", help="Write paired-end reads to two files")
+    parser.add_argument("--compress", choices=["none", "gzip", "bgzf"], default="none",
+                        help="Output compression (default none)")
+    parser.add_argument("--level", type=int, default=6, help="Compression level for gzip and BGZF (default 6)")
+    parser.add_argument("--at-quality", type=float, default=0.0,
+                        help="Fraction of reads whose quality line starts with '@' (default 0)")
+    return parser.parse_args()
+
+
+class LengthDistribution:
+    """
+    Read length distribution, from a 'fixed:N', 'uniform:MIN:MAX' or 'normal:MEAN:SD' spec.
+    """
+
+    def __init__(self, spec):
+        """
+        Initiator.
+
+        args:
+        - spec: distribution name and its parameters, separated by colons
+        """
+        self.kind, *values = spec.split(":")
+        self.values = [float(value) for value in values]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2}
+        if expected.get(self.kind) != len(self.values):
+            raise ValueError(f"invalid read length distribution: {spec}")
+        self.longest = int(self.values[0] if self.kind == "fixed" else
+                           self.values[1] if self.kind == "uniform" else
+                           self.values[0] + 6 * self.values[1])
+
+    def sample(self, rng, amount):
+        """
+        returns:
+        - int64 array with the length of every read, at least 1
+        """
+        if self.kind == "fixed":
+            lengths = np.full(amount, self.values[0])
+        elif self.kind == "uniform":
+            lengths = rng.integers(self.values[0], self.values[1], amount, endpoint=True)
+        else:
+            lengths = np.rint(rng.normal(self.values[0], self.values[1], amount))
+        return np.clip(lengths, 1, max(self.longest, 1)).astype(np.int64)
+
+
+def quality_table(spec, longest):
+    """
+    Builds a lookup table with 256 equally likely quality characters per base position,
+    so a random byte per base is enough to draw its score.
+
+    args:
+    - spec: 'illumina', 'flat:Q' or 'uniform:MIN:MAX'
+    - longest: longest possible read
+
+    returns:
+    - uint8 array of shape (longest, 256) with Phred+33 characters
+    """
+    kind, *values = spec.split(":")
+    fraction = np.arange(longest)[:, None] / max(longest - 1, 1)
+    quantiles = (np.arange(256) + 0.5) / 256
+    if kind == "illumina" and not values:
+        # high at the start of a read, slowly dropping and spreading towards the end
+        normal = np.array([NormalDist().inv_cdf(quantile) for quantile in quantiles])
+        scores = 37 - 10 * fraction ** 2 + (2 + 4 * fraction) * normal
+    elif kind == "flat" and len(values) == 1:
+        scores = np.full((longest, 256), float(values[0]))
+    elif kind == "uniform" and len(values) == 2:
+        low, high = int(values[0]), int(values[1])
+        scores = np.broadcast_to(low + np.floor(quantiles * (high - low + 1)), (longest, 256))
+    else:
+        raise ValueError(f"invalid quality profile: {spec}")
+    return (np.clip(np.rint(scores), 2, 41) + 33).astype(np.uint8)
+
+
+def make_batch(rng, first, mate, lengths, profile, at_quality):
+    """
+    Generates one batch of FastQ records. Headers, sequences and quality lines are
+    made in bulk and scattered into one buffer, instead of building every record.
+
+    args:
+    - rng: numpy Generator
+    - first: number of the first read in the batch
+    - mate: 1 or 2 for paired-end reads, None otherwise
+    - lengths: length of every read in the batch
+    - profile: lookup table from quality_table
+    - at_quality: fraction of reads whose quality line starts with '@'
+
+    returns:
+    - (bytes of the batch, int64 array with the end of every record in those bytes)
+    """
+    total = int(lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(total) - np.repeat(offsets, lengths)
+
+    sequences = BASES[np.frombuffer(rng.bytes(total), dtype=np.uint8) & 3]
+    qualities = profile.ravel()[positions * 256 + np.frombuffer(rng.bytes(total), dtype=np.uint8)]
+    # Q31 is '@', which makes a quality line look like a header
+    qualities[offsets[rng.random(len(lengths)) < at_quality]] = ord("@")
+
+    suffix = f" {mate}:N:0:1" if mate else ""
+    numbers = range(first, first + len(lengths))
+    headers = ("@SYN." + f"{suffix}\n@SYN.".join(map(str, numbers)) + f"{suffix}\n").encode()
+    digits = np.searchsorted(10 ** np.arange(1, 19), np.array(numbers), side="right") + 1
+    header_lengths = digits + len(f"@SYN.{suffix}\n")
+
+    # record layout: header, sequence, "\n+\n", quality line, "\n"
+    record_lengths = header_lengths + 2 * lengths + 4
+    ends = np.cumsum(record_lengths)
+    starts = ends - record_lengths
+    data = np.empty(int(ends[-1]), dtype=np.uint8)
+    data[np.repeat(starts - (np.cumsum(header_lengths) - header_lengths), header_lengths)
+         + np.arange(len(headers))] = np.frombuffer(headers, dtype=np.uint8)
+    sequence_starts = np.repeat(starts + header_lengths, lengths) + positions
+    data[sequence_starts] = sequences
+    data[starts + header_lengths + lengths] = ord("\n")
+    data[starts + header_lengths + lengths + 1] = ord("+")
+    data[starts + header_lengths + lengths + 2] = ord("\n")
+    data[sequence_starts + lengths.repeat(lengths) + 3] = qualities
+    data[ends - 1] = ord("\n")
+    return data.tobytes(), ends
+
+
+class BgzfWriter:
+    """
+    Writes BGZF: a series of independent gzip members of at most 64 KB each, so the
+    assignments can split the compressed file on block boundaries.
+    """
+
+    def __init__(self, path, level=6):
+        """
+        Initiator.
+
+        args:
+        - path: file to write
+        - level: zlib compression level
+        """
+        self.file = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """
+        Buffers data and writes every full block.
+        """
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK:
+            self.write_block(bytes(self.buffer[:BGZF_BLOCK]))
+            del self.buffer[:BGZF_BLOCK]
+
+    def write_block(self, data):
+        """
+        Writes one gzip member with the BC extra field holding its size.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        self.file.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+                        + struct.pack("<H", len(deflated) + 25) + deflated
+                        + struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def close(self):
+        """
+        Writes the last block and the empty end-of-file block.
+        """
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+        self.file.write(BGZF_EOF)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, compress, level):
+    """
+    returns:
+    - a binary file object for the given compression
+    """
+    if compress == "gzip":
+        return gzip.open(path, 'wb', compresslevel=level)
+    if compress == "bgzf":
+        return BgzfWriter(path, level)
+    return open(path, 'wb', buffering=1 << 22)
+
+
+def mate_paths(path):
+    """
+    Adds _1 and _2 to a file name, in front of the .fastq part when it has one.
+
+    returns:
+    - (path of mate 1, path of mate 2)
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extension = name.partition(".fastq") if ".fastq" in name else (*os.path.splitext(name), "")
+    return tuple(os.path.join(directory, f"{stem}_{mate}{dot}{extension}") for mate in (1, 2))
+
+
+def generate(args):
+    """
+    Generates the reads batch by batch and writes them until every file reached --size.
+    """
+    rng = np.random.default_rng(args.seed)
+    lengths = LengthDistribution(args.length)
+    profile = quality_table(args.profile, lengths.longest)
+
+    paths = mate_paths(args.output) if args.paired else (args.output,)
+    outputs = [open_output(path, args.compress, args.level) for path in paths]
+    written = 0
+    first = 0
+    try:
+        while written < args.size:
+            batch_lengths = [lengths.sample(rng, BATCH) for _ in outputs]
+            batches = [make_batch(rng, first, mate if args.paired else None, batch_lengths[mate - 1],
+                                  profile, args.at_quality) for mate in range(1, len(outputs) + 1)]
+            # stop after the record that reaches --size in the first file; mates stay in step
+            keep = min(int(np.searchsorted(batches[0][1], args.size - written)), BATCH - 1)
+            for output, (data, ends) in zip(outputs, batches):
+                output.write(memoryview(data)[:ends[keep]])
+            written += int(batches[0][1][keep])
+            first += BATCH
+    finally:
+        for output in outputs:
+            output.close()
+
+    for path in paths:
+        print(f"[Status] Wrote {path} ({os.path.getsize(path)} bytes on disk)", file=sys.stderr)
+
+
+def main():
+    """
+    Main function.
+    """
+    args = parse_arguments()
+    try:
+        generate(args)
+    except ValueError as err:
+        print(f"[Error] {err}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
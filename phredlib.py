@@ -0,0 +1,705 @@
+#!/usr/bin/env python3
+
+"""Big Data Computing (BDC) shared Phred score helpers.
+
+Everything the assignments have in common about reading FastQ files: finding
+record starts, the .fqi record index, BGZF and gzip input, memory-mapped
+chuncks, the vectorized decode_qualities kernel, the --metrics records, the
+result cache and the --incremental checkpoints. Every assignment puts the
+root of the repository on sys.path and imports what it needs from here.
+"""
+
+__author__ = "Dennis Scheper"
+__status__ = "Production"
+__version__ = "v1.0"
+__date__ = "30/06/2024"
+__contact__ = "d.j.scheper@st.hanze.nl"
+
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import resource
+import socket
+import time
+import numpy as np
+
+INDEX_SUFFIX = ".fqi"
+# checkpoint of --incremental: the offset after the last processed record, a hash of
+# CHECKPOINT_TAIL bytes before it and the sums and counts of everything up to there
+CHECKPOINT_SUFFIX = ".phk"
+CHECKPOINT_TAIL = 1 << 12
+# result cache: entries are named after the fingerprint of a file, which hashes
+# CACHE_SAMPLES evenly spread blocks of CACHE_SAMPLE_SIZE bytes next to its size and mtime
+CACHE_SUFFIX = ".phc"
+CACHE_SAMPLES = 16
+CACHE_SAMPLE_SIZE = 1 << 16
+CACHE_DIR = os.environ.get("BDC_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "bdc"))
+# amount of bytes decode_windows hands to decode_qualities at once
+DECODE_WINDOW = 1 << 25
+
+
+def find_record(data, offset, final=True, window=1 << 16):
+    """
+    Finds the first FastQ record that starts at or after an offset in a buffer.
+    A line starting with an '@' is only accepted as a header when the line two
+    further down starts with a '+', so quality lines that happen to begin with
+    an '@' are skipped.
+
+    args:
+    - data: bytes to search in
+    - offset: position to start from; only a line start when it follows a newline
+    - final: whether data runs up to the end of the file
+    - window: amount of bytes to split into lines at once, doubled when needed
+
+    returns:
+    - the position of the record, len(data) when final and no record follows,
+      or None when more data is needed to decide
+    """
+    if offset > 0 and data[offset - 1:offset] != b"\n":
+        newline = data.find(b"\n", offset)
+        offset = len(data) if newline < 0 else newline + 1
+
+    while True:
+        lines = data[offset:offset + window].split(b"\n")
+        last = offset + window >= len(data)
+        complete = len(lines) if last and final else len(lines) - 1
+        position = offset
+
+        for i in range(complete - 3):
+            if lines[i].startswith(b"@") and lines[i + 2].startswith(b"+"):
+                return position
+            position += len(lines[i]) + 1
+
+        if last:
+            return len(data) if final else None
+        window *= 2
+
+
+def align_to_record(inputfile, offset, window=1 << 16):
+    """
+    Snaps a byte offset to the start of the first FastQ record at or after it.
+
+    args:
+    - inputfile: FastQ file opened in binary mode
+    - offset: position in bytes to snap
+    - window: amount of bytes to look ahead, doubled until a record is found
+
+    returns:
+    - the position of the record in bytes, or the size of the file
+    """
+    file_size = os.fstat(inputfile.fileno()).st_size
+    if offset <= 0 or offset >= file_size:
+        return min(max(offset, 0), file_size)
+
+    while True:
+        # start one byte early to see whether the offset is the start of a line
+        inputfile.seek(offset - 1)
+        data = inputfile.read(window)
+        position = find_record(data, 1, final=len(data) < window)
+        if position is not None:
+            return offset - 1 + position
+        window *= 2
+
+
+def build_index(fastq, interval, block=1 << 24):
+    """
+    Scans a FastQ file once and collects the offset of every interval-th record.
+    Records are four lines long, so record k starts after the 4k-th newline.
+
+    args:
+    - fastq: path to the FastQ file
+    - interval: amount of records between two offsets
+    - block: amount of bytes to read at once
+
+    returns:
+    - int64 array with record offsets, starting at 0
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    seen = 0
+    with open(fastq, 'rb') as inputfile:
+        while True:
+            position = inputfile.tell()
+            data = inputfile.read(block)
+            if not data:
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+            numbers = seen + np.arange(1, len(newlines) + 1)
+            offsets.append(position + newlines[numbers % (4 * interval) == 0] + 1)
+            seen += len(newlines)
+
+    offsets = np.concatenate(offsets)
+    # a final newline does not start another record
+    return offsets[(offsets == 0) | (offsets < os.stat(fastq).st_size)]
+
+
+def load_index(fastq, interval):
+    """
+    Loads the .fqi sidecar of a FastQ file, or builds and stores it when it is
+    missing or stale. The sidecar holds the file size, modification time and
+    interval it was built for, followed by the record offsets.
+
+    args:
+    - fastq: path to the FastQ file
+    - interval: amount of records between two offsets
+
+    returns:
+    - int64 array with record offsets
+    """
+    stat = os.stat(fastq)
+    header = [stat.st_size, stat.st_mtime_ns, interval]
+    path = fastq + INDEX_SUFFIX
+
+    if os.path.exists(path):
+        stored = np.fromfile(path, dtype="<i8")
+        if stored[:3].tolist() == header:
+            return stored[3:]
+
+    offsets = build_index(fastq, interval)
+    try:
+        np.concatenate((header, offsets)).astype("<i8").tofile(path)
+    except OSError as err:
+        print(f"{err}: Could not write the index next to the FastQ file, continuing without it.")
+    return offsets
+
+
+def fingerprint(fastq, samples=CACHE_SAMPLES, block=CACHE_SAMPLE_SIZE):
+    """
+    Content fingerprint of a file for the result cache: its size and modification time,
+    plus a hash of a few blocks spread evenly over the file, including the first and
+    the last one. Only samples * block bytes are read, whatever the size of the file.
+
+    args:
+    - fastq: path to the file
+    - samples: amount of blocks to hash
+    - block: size of every block in bytes
+
+    returns:
+    - the fingerprint as a hex string
+    """
+    stat = os.stat(fastq)
+    digest = hashlib.blake2b(f"{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=20)
+    last = max(stat.st_size - block, 0)
+    with open(fastq, 'rb') as inputfile:
+        for offset in sorted({last * i // max(samples - 1, 1) for i in range(samples)}):
+            inputfile.seek(offset)
+            digest.update(inputfile.read(block))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of per-position sums and counts, one entry per file fingerprint, so a
+    file that was processed before is not read again. Entries hold the sums followed
+    by the counts as little-endian int64. Every hit touches its entry, and after every
+    store the least recently used entries are removed until the cache fits its limit.
+    Entries are written to a temporary file and renamed, so concurrent runs can share
+    a cache directory.
+
+    Functions:
+    - load: returns the sums and counts of a fingerprint, or None
+    - store: adds the sums and counts of a fingerprint
+    - evict: removes the least recently used entries above the size limit
+    """
+
+    def __init__(self, directory=CACHE_DIR, limit=64 << 20):
+        """
+        Initiator.
+
+        args:
+        - directory: directory of the cache, created when missing
+        - limit: maximum size of all entries together in bytes
+        """
+        self.directory = directory
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        returns:
+        - path of the entry of a fingerprint
+        """
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def load(self, key):
+        """
+        returns:
+        - (sums, counts) tuple of int64 arrays, or None when the fingerprint is unknown
+        """
+        try:
+            stored = np.fromfile(self.path(key), dtype="<i8")
+            os.utime(self.path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(stored) % 2:
+            return None
+        sums, counts = stored.astype(np.int64).reshape(2, -1)
+        return sums, counts
+
+    def store(self, key, totals):
+        """
+        Adds an entry, then evicts the least recently used ones when needed.
+        """
+        temporary = f"{self.path(key)}.{os.getpid()}.tmp"
+        try:
+            np.stack(totals).astype("<i8").tofile(temporary)
+            os.replace(temporary, self.path(key))
+        except OSError as err:
+            print(f"{err}: Could not write to the result cache, continuing without it.")
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until all of them fit in the limit.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+def last_record_end(fastq, start, window=1 << 16):
+    """
+    Finds the end of the last complete record of a file that may still be written
+    to. Only the tail of the file is searched: the last record whose four lines all
+    end in a newline is found with find_record, so a record that is half written is
+    left for the next run. A last record without its final newline only counts when
+    its quality line is as long as its sequence and the file did not change while it
+    was read; load_checkpoint skips the newline when it is appended later.
+
+    args:
+    - fastq: path to the FastQ file
+    - start: start of a record; nothing before it is searched
+    - window: amount of bytes at the end to search, doubled until a record is found
+
+    returns:
+    - the position after the last complete record, or start when there is none
+    """
+    before = os.stat(fastq)
+    size = before.st_size
+    with open(fastq, 'rb') as inputfile:
+        while True:
+            # start one byte early to see whether the window starts at a line start
+            begin = max(start, size - window)
+            inputfile.seek(max(begin - 1, 0))
+            data = inputfile.read(size - max(begin - 1, 0))
+            shift = begin - max(begin - 1, 0)
+            last = None
+            position = find_record(data, shift, final=False)
+            while position is not None and position < len(data):
+                last = position
+                position = find_record(data, position + 1, final=False)
+            if last is not None or begin == start:
+                end = shift if last is None else last
+                for _ in range(4 if last is not None else 0):
+                    end = data.index(b"\n", end) + 1
+                lines = data[end:].split(b"\n")
+                after = os.stat(fastq)
+                if (len(lines) == 4 and lines[0].startswith(b"@") and lines[2].startswith(b"+")
+                        and 0 < len(lines[3]) == len(lines[1])
+                        and (after.st_size, after.st_mtime_ns) == (size, before.st_mtime_ns)):
+                    end = len(data)
+                return max(begin - shift, 0) + end
+            window *= 2
+
+
+def tail_hash(inputfile, offset):
+    """
+    returns:
+    - signed 64-bit hash of the CHECKPOINT_TAIL bytes before an offset
+    """
+    inputfile.seek(max(offset - CHECKPOINT_TAIL, 0))
+    digest = hashlib.blake2b(inputfile.read(min(offset, CHECKPOINT_TAIL)), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def load_checkpoint(fastq):
+    """
+    Loads the --incremental checkpoint of a FastQ file. It is only used when the file
+    still holds the same bytes before the checkpointed offset, so a file that was
+    truncated or replaced is processed from the start again. A newline right at the
+    offset belongs to the last processed record and is skipped.
+
+    returns:
+    - (offset, (sums, counts)) of the processed part, or (0, None) without a valid checkpoint
+    """
+    path = fastq + CHECKPOINT_SUFFIX
+    try:
+        stored = np.fromfile(path, dtype="<i8")
+    except (FileNotFoundError, ValueError):
+        return 0, None
+    if len(stored) < 3 or len(stored) != 3 + 2 * stored[2]:
+        return 0, None
+    offset, digest = int(stored[0]), int(stored[1])
+    if offset > os.stat(fastq).st_size:
+        return 0, None
+    with open(fastq, 'rb') as inputfile:
+        if tail_hash(inputfile, offset) != digest:
+            return 0, None
+        # the last record may have been stored before its final newline was written
+        inputfile.seek(offset)
+        if offset and inputfile.read(1) == b"\n":
+            offset += 1
+    sums, counts = stored[3:].astype(np.int64).reshape(2, -1)
+    return offset, (sums, counts)
+
+
+def store_checkpoint(fastq, offset, totals):
+    """
+    Stores the --incremental checkpoint of a FastQ file next to it, through a temporary
+    file so an interrupted run never leaves half a checkpoint behind.
+
+    args:
+    - fastq: path to the FastQ file
+    - offset: position after the last processed record
+    - totals: (sums, counts) tuple of everything before offset
+    """
+    with open(fastq, 'rb') as inputfile:
+        header = [offset, tail_hash(inputfile, offset), len(totals[0])]
+    path = fastq + CHECKPOINT_SUFFIX
+    try:
+        np.concatenate((header, *totals)).astype("<i8").tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        print(f"{err}: Could not write the checkpoint next to the FastQ file, the next run starts over.")
+
+
+def bgzf_block_size(inputfile):
+    """
+    Reads the gzip header at the current position of a file and returns the size
+    of the block from its BGZF 'BC' extra subfield.
+
+    args:
+    - inputfile: file opened in binary mode, positioned at the start of a block
+
+    returns:
+    - the compressed size of the block in bytes, or None when it is not a BGZF block
+    """
+    header = inputfile.read(12)
+    if len(header) < 12 or header[:2] != b"\x1f\x8b" or not header[3] & 4:
+        return None
+
+    extra = inputfile.read(int.from_bytes(header[10:12], "little"))
+    i = 0
+    while i + 4 <= len(extra):
+        length = int.from_bytes(extra[i + 2:i + 4], "little")
+        if extra[i:i + 2] == b"BC" and length == 2:
+            return int.from_bytes(extra[i + 4:i + 6], "little") + 1
+        i += 4 + length
+    return None
+
+
+def detect_compression(fastq):
+    """
+    Checks the magic bytes of a FastQ file.
+
+    returns:
+    - None for uncompressed files, "bgzf" for blocked gzip and "gzip" otherwise
+    """
+    with open(fastq, 'rb') as inputfile:
+        if inputfile.read(2) != b"\x1f\x8b":
+            return None
+        inputfile.seek(0)
+        return "bgzf" if bgzf_block_size(inputfile) else "gzip"
+
+
+def bgzf_blocks(fastq):
+    """
+    Walks the block headers of a BGZF file.
+
+    returns:
+    - int64 array with the compressed offset of every block
+    """
+    offsets = []
+    with open(fastq, 'rb') as inputfile:
+        file_size = os.fstat(inputfile.fileno()).st_size
+        position = 0
+        while position < file_size:
+            offsets.append(position)
+            inputfile.seek(position)
+            position += bgzf_block_size(inputfile)
+    return np.array(offsets, dtype=np.int64)
+
+
+def inflate_bgzf(fastq, start, end):
+    """
+    Decompresses the BGZF blocks between two compressed block offsets. Records
+    cross block boundaries, so a range keeps every record that starts after its
+    first byte (or at 0) up to the first record that starts after its last byte,
+    inflating following blocks when needed. Neighbouring ranges therefore never
+    share or miss a record, and every worker can decompress its own range.
+
+    args:
+    - fastq: path to the BGZF file
+    - start: compressed offset of the first block
+    - end: compressed offset of the block after the range
+
+    returns:
+    - memoryview over the decompressed, record-aligned data
+    """
+    if end <= start:
+        return memoryview(b"")
+
+    with open(fastq, 'rb') as inputfile:
+        file_size = os.fstat(inputfile.fileno()).st_size
+        inputfile.seek(start)
+        data = gzip.decompress(inputfile.read(end - start))
+        own = len(data)
+        position = end
+
+        while True:
+            final = position >= file_size
+            first = 0 if start == 0 else find_record(data, 1, final=final)
+            last = find_record(data, own + 1, final=final)
+            if first is not None and last is not None:
+                return memoryview(data)[first:last]
+
+            inputfile.seek(position)
+            block_size = bgzf_block_size(inputfile)
+            inputfile.seek(position)
+            data += gzip.decompress(inputfile.read(block_size))
+            position += block_size
+
+
+def stream_gzip(fastq, block=1 << 23):
+    """
+    Decompresses a gzip file piece by piece and yields record-aligned pieces.
+    The file starts with a record and records are four lines long, so every
+    piece is cut after a multiple of four newlines and the rest carries over.
+
+    args:
+    - fastq: path to the gzip file
+    - block: amount of decompressed bytes to read at once
+
+    yields:
+    - bytes holding whole records
+    """
+    rest = b""
+    with gzip.open(fastq, 'rb') as inputfile:
+        while True:
+            piece = inputfile.read(block)
+            data = rest + piece
+            if not piece:
+                if data:
+                    yield data
+                return
+
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+            cut = newlines[4 * (len(newlines) // 4) - 1] + 1 if len(newlines) >= 4 else 0
+            rest = data[cut:]
+            if cut:
+                yield data[:cut]
+
+
+def map_chunck(fastq, start, end):
+    """
+    Memory-maps a byte range of a FastQ file and returns it as a read-only NumPy
+    view. Nothing is copied into Python objects, and workers on the same node
+    share the pages through the page cache instead of each holding a copy.
+    Decode the view with decode_windows, so the memory a chunck takes stays
+    bounded by the window instead of growing with the mapped range.
+
+    args:
+    - fastq: path to the FastQ file
+    - start: first byte of the range
+    - end: byte after the last byte of the range
+
+    returns:
+    - uint8 array backed by the mapping; the mapping lives as long as the array
+    """
+    if end <= start:
+        return np.zeros(0, dtype=np.uint8)
+
+    # the mapping itself has to start on a multiple of the allocation granularity
+    offset = start - start % mmap.ALLOCATIONGRANULARITY
+    with open(fastq, 'rb') as inputfile:
+        mapped = mmap.mmap(inputfile.fileno(), end - offset, offset=offset, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return np.frombuffer(mapped, dtype=np.uint8, count=end - start, offset=start - offset)
+
+
+def decode_qualities(chunk):
+    """
+    Vectorized decoding of the quality lines in a chunk of whole FastQ records.
+    Every fourth line of the chunk is a quality line; instead of looping over
+    every byte, the lines are found with NumPy and summed in bulk.
+
+    args:
+    - chunk: bytes-like object or uint8 array that starts at the beginning of a record
+
+    returns:
+    - (sums, counts): int64 arrays with the Phred score sum and the amount of
+                      scores per base position
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord("\n"))
+    if len(data) and data[-1] != ord("\n"):
+        newlines = np.append(newlines, len(data))
+
+    # quality lines run from the character after the third newline up to the fourth
+    starts = newlines[2::4] + 1
+    ends = newlines[3::4]
+    starts = starts[:len(ends)]
+    if not len(ends):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ends = ends - ((ends > starts) & (data[ends - 1] == ord("\r")))
+    lengths = ends - starts
+    length = lengths.max()
+
+    # mark every byte that belongs to a quality line and gather them in one go
+    marks = np.zeros(len(data) + 1, dtype=np.int8)
+    marks[starts] += 1
+    marks[ends] -= 1
+    quals = data[np.cumsum(marks[:-1], dtype=np.int8).view(bool)]
+
+    if np.all(lengths == length):
+        # all reads are equally long: a simple reshape gives one row per read
+        counts = np.full(length, len(lengths), dtype=np.int64)
+        sums = quals.reshape(len(lengths), length).sum(axis=0, dtype=np.int64)
+    else:
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(len(quals)) - np.repeat(offsets, lengths)
+        counts = np.bincount(positions, minlength=length).astype(np.int64)
+        sums = np.bincount(positions, weights=quals, minlength=length).astype(np.int64)
+
+    return sums - 33 * counts, counts
+
+
+def decode_windows(chunk, window=DECODE_WINDOW):
+    """
+    Runs decode_qualities over a chunk in record-aligned windows and adds the
+    results together. decode_qualities needs a few times the memory of what it
+    decodes, so a whole chunck at once would cost a multiple of the chunck size;
+    windows keep that bounded no matter how large the chunck or mapped range is.
+    Like stream_gzip, every window is cut after a multiple of four newlines.
+
+    args:
+    - chunk: bytes-like object or uint8 array that starts at the beginning of a record
+    - window: amount of bytes to decode at once, doubled when a window holds no whole record
+
+    returns:
+    - (sums, counts): int64 arrays with the Phred score sum and the amount of
+                      scores per base position
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    sums, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    start, size = 0, window
+    while start < len(data):
+        piece = data[start:start + size]
+        cut = len(piece)
+        if start + size < len(data):
+            newlines = np.flatnonzero(piece == ord("\n"))
+            if len(newlines) < 4:
+                size *= 2
+                continue
+            cut = int(newlines[4 * (len(newlines) // 4) - 1]) + 1
+
+        piece_sums, piece_counts = decode_qualities(piece[:cut])
+        length = max(len(sums), len(piece_sums))
+        sums, counts = pad_totals((sums, counts), length)
+        piece_sums, piece_counts = pad_totals((piece_sums, piece_counts), length)
+        sums, counts = sums + piece_sums, counts + piece_counts
+        start, size = start + cut, window
+
+    return sums, counts
+
+
+def pad_totals(totals, length):
+    """
+    Pads per-position sums and counts with zeros up to the given amount of positions.
+
+    args:
+    - totals: (sums, counts) tuple
+    - length: amount of positions to pad to
+
+    returns:
+    - (sums, counts) tuple of int64 arrays of the given length
+    """
+    sums, counts = totals
+    return (np.pad(np.asarray(sums, dtype=np.int64), (0, length - len(sums))),
+            np.pad(np.asarray(counts, dtype=np.int64), (0, length - len(counts))))
+
+
+def measure(function, *args):
+    """
+    Runs function(*args) for the --metrics instrumentation. Wall time that this process
+    did not spend on the CPU counts as I/O wait; for memory-mapped chuncks that includes
+    the page faults while decoding, on a busy host also the wait for a free core.
+
+    returns:
+    - (result, dict with the wall, cpu and I/O wait seconds and the peak RSS in KB)
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return result, {"wall_seconds": wall, "cpu_seconds": cpu, "io_wait_seconds": max(wall - cpu, 0.0),
+                    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def chunck_metrics(chunck, result):
+    """
+    Sizes of one chunck and of its result for the --metrics instrumentation. The result
+    is pickled once, as it would be to send it back, to measure serialization.
+
+    args:
+    - chunck: (start, end) tuple, or the bytes of a streamed gzip piece
+    - result: (sums, counts) tuple or defaultdict of the chunck
+
+    returns:
+    - dict with the chunck bytes, records, result bytes and serialization seconds
+    """
+    started = time.perf_counter()
+    result_bytes = len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    serialize = time.perf_counter() - started
+    if isinstance(result, tuple):
+        records = int(result[1][0]) if len(result[1]) else 0
+    else:
+        records = len(result.get(0, ()))
+    is_range = isinstance(chunck, tuple)
+    return {"chunck": [int(bound) for bound in chunck] if is_range else None,
+            "bytes": int(chunck[1] - chunck[0]) if is_range else len(chunck),
+            "records": records, "result_bytes": result_bytes, "serialize_seconds": serialize}
+
+
+def metrics_record(event, backend, fastq, **fields):
+    """
+    returns:
+    - one --metrics record with the fields every record shares
+    """
+    return {"event": event, "backend": backend, "file": fastq, "host": socket.gethostname(),
+            "pid": os.getpid(), "time": time.time(), **fields}
+
+
+def write_metrics(path, records):
+    """
+    Appends records to the metrics file as JSON lines, in a single write so the lines
+    of concurrent processes do not get mixed up.
+    """
+    with open(path, 'a', encoding='UTF-8') as sink:
+        sink.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def timings_line(read, parse, reduce, write, total):
+    """
+    returns:
+    - the "[Timings] {...}" line benchmark.py reads the seconds spent per phase from
+    """
+    return "[Timings] " + json.dumps({"read": read, "parse": parse, "reduce": reduce, "write": write,
+                                      "total": total})
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""Tests for the shared FastQ helpers in phredlib.py and the binary records of assignment 3.
+
+Run from the root of the repository with: python3 -m pytest test_phredlib.py
+"""
+
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+from phredlib import (ResultCache, align_to_record, decode_qualities, decode_windows, find_record,
+                      last_record_end, load_checkpoint, store_checkpoint)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "Assignment3"))
+import assignment3
+
+
+def make_records(amount, seed=0):
+    """
+    Random FastQ records of different lengths; every third quality line starts with an
+    '@' and every fifth with a '+', so they look like the first line of a record.
+
+    returns:
+    - list of (record bytes, quality string) tuples
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for number in range(amount):
+        length = int(rng.integers(1, 40))
+        sequence = "".join(rng.choice(list("ACGTN"), length))
+        quality = "".join(chr(33 + int(score)) for score in rng.integers(0, 41, length))
+        if number % 3 == 0:
+            quality = "@" + quality[1:]
+        elif number % 5 == 0:
+            quality = "+" + quality[1:]
+        records.append((f"@read{number}\n{sequence}\n+\n{quality}\n".encode(), quality))
+    return records
+
+
+def naive_totals(qualities):
+    """
+    returns:
+    - (sums, counts) per base position, added up record by record
+    """
+    length = max(len(quality) for quality in qualities)
+    sums, counts = np.zeros(length, dtype=np.int64), np.zeros(length, dtype=np.int64)
+    for quality in qualities:
+        for position, char in enumerate(quality):
+            sums[position] += ord(char) - 33
+            counts[position] += 1
+    return sums, counts
+
+
+def assert_totals(totals, expected):
+    sums, counts = totals
+    np.testing.assert_array_equal(sums, expected[0])
+    np.testing.assert_array_equal(counts, expected[1])
+    np.testing.assert_allclose(sums / counts, expected[0] / expected[1])
+
+
+def test_decode_qualities_matches_naive_average():
+    records = make_records(200)
+    data = b"".join(record for record, _ in records)
+    assert_totals(decode_qualities(data), naive_totals([quality for _, quality in records]))
+
+
+def test_decode_qualities_without_final_newline():
+    records = make_records(20)
+    data = b"".join(record for record, _ in records)[:-1]
+    assert_totals(decode_qualities(data), naive_totals([quality for _, quality in records]))
+
+
+@pytest.mark.parametrize("window", [8, 64, 100, 1 << 20])
+def test_decode_windows_matches_naive_average(window):
+    """Small windows cut through records or hold less than a whole record."""
+    records = make_records(200, seed=1)
+    data = b"".join(record for record, _ in records)
+    assert_totals(decode_windows(data, window=window), naive_totals([quality for _, quality in records]))
+
+
+def test_decode_windows_record_across_window_boundary():
+    records = make_records(3, seed=7)
+    data = b"".join(record for record, _ in records)
+    # the first window ends halfway through the second record
+    window = len(records[0][0]) + len(records[1][0]) // 2
+    assert_totals(decode_windows(data, window=window), naive_totals([quality for _, quality in records]))
+
+
+def test_decode_windows_of_nothing():
+    sums, counts = decode_windows(b"")
+    assert len(sums) == len(counts) == 0
+
+
+def test_find_record_skips_quality_lines_that_look_like_headers():
+    records = make_records(30, seed=2)
+    data = b"".join(record for record, _ in records)
+    starts = list(np.cumsum([0] + [len(record) for record, _ in records[:-1]]))
+    for offset in range(len(data) + 1):
+        expected = next((start for start in starts if start >= offset), len(data))
+        assert find_record(data, offset, window=16) == expected
+
+
+def test_find_record_asks_for_more_data():
+    record = make_records(1)[0][0]
+    # the quality line of the last record is not complete yet
+    assert find_record(record[:-3], 1, final=False) is None
+
+
+def test_align_to_record_skips_quality_lines_that_look_like_headers(tmp_path):
+    records = make_records(30, seed=3)
+    data = b"".join(record for record, _ in records)
+    path = tmp_path / "reads.fastq"
+    path.write_bytes(data)
+    starts = list(np.cumsum([0] + [len(record) for record, _ in records[:-1]]))
+    with open(path, 'rb') as inputfile:
+        for offset in range(-1, len(data) + 2):
+            expected = next((start for start in starts if start >= offset), len(data))
+            assert align_to_record(inputfile, offset, window=8) == expected
+
+
+def test_totals_records_round_trip():
+    stream = io.BytesIO()
+    first = (np.array([10, 20, 30], dtype=np.int64), np.array([1, 2, 3], dtype=np.int64))
+    second = (np.array([5], dtype=np.int64), np.array([1], dtype=np.int64))
+    measurements = [{"event": "chunck", "bytes": 12}, {"event": "chunck", "bytes": 34}]
+    assignment3.write_totals(*first, stream)
+    assignment3.write_measurements(measurements, stream)
+    assignment3.write_totals(*second, stream)
+
+    stream.seek(0)
+    received = []
+    totals = list(assignment3.read_totals(stream, received))
+    assert len(totals) == 2
+    for (sums, counts), expected in zip(totals, (first, second)):
+        np.testing.assert_array_equal(sums, expected[0])
+        np.testing.assert_array_equal(counts, expected[1])
+    assert received == measurements
+
+
+def test_totals_records_without_measurements_list():
+    stream = io.BytesIO()
+    assignment3.write_measurements([{"event": "chunck"}], stream)
+    assignment3.write_totals(np.array([1]), np.array([1]), stream)
+    stream.seek(0)
+    assert len(list(assignment3.read_totals(stream))) == 1
+
+
+@pytest.mark.parametrize("cut", [3, assignment3.RECORD.size + 5, -1])
+def test_truncated_totals_record(cut):
+    stream = io.BytesIO()
+    assignment3.write_totals(np.array([1, 2]), np.array([1, 1]), stream)
+    with pytest.raises(ValueError):
+        list(assignment3.read_totals(io.BytesIO(stream.getvalue()[:cut])))
+
+
+def test_truncated_measurements_record():
+    stream = io.BytesIO()
+    assignment3.write_measurements([{"event": "chunck"}], stream)
+    with pytest.raises(ValueError):
+        list(assignment3.read_totals(io.BytesIO(stream.getvalue()[:-2]), []))
+
+
+def test_unknown_record():
+    stream = io.BytesIO(assignment3.RECORD.pack(b"XXXX", 0))
+    with pytest.raises(ValueError):
+        list(assignment3.read_totals(stream))
+
+
+def test_result_cache_store_and_load(tmp_path):
+    cache = ResultCache(str(tmp_path), limit=1 << 20)
+    totals = (np.array([3, 6, 9], dtype=np.int64), np.array([1, 2, 3], dtype=np.int64))
+    assert cache.load("missing") is None
+    cache.store("key", totals)
+    sums, counts = cache.load("key")
+    np.testing.assert_array_equal(sums, totals[0])
+    np.testing.assert_array_equal(counts, totals[1])
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    totals = (np.arange(3, dtype=np.int64), np.ones(3, dtype=np.int64))
+    entry = 2 * 3 * 8
+    cache = ResultCache(str(tmp_path), limit=2 * entry)
+    cache.store("first", totals)
+    cache.store("second", totals)
+    for key in ("first", "second"):
+        os.utime(cache.path(key), ns=(1, 1))
+    # a hit makes first the most recently used entry
+    assert cache.load("first") is not None
+
+    cache.store("third", totals)
+    assert cache.load("second") is None
+    assert cache.load("first") is not None
+    assert cache.load("third") is not None
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= cache.limit
+
+
+def test_checkpoint_round_trip_after_append(tmp_path):
+    records = make_records(60, seed=4)
+    path = str(tmp_path / "growing.fastq")
+    first = b"".join(record for record, _ in records[:40])
+    with open(path, 'wb') as outputfile:
+        # the last record is still being written
+        outputfile.write(first + records[40][0][:10])
+    end = last_record_end(path, 0, window=64)
+    assert end == len(first)
+    store_checkpoint(path, end, decode_qualities(first))
+
+    with open(path, 'ab') as outputfile:
+        outputfile.write(records[40][0][10:] + b"".join(record for record, _ in records[41:]))
+    offset, checkpoint = load_checkpoint(path)
+    assert offset == len(first)
+    assert_totals(checkpoint, naive_totals([quality for _, quality in records[:40]]))
+
+    end = last_record_end(path, offset, window=64)
+    assert end == os.path.getsize(path)
+    with open(path, 'rb') as inputfile:
+        inputfile.seek(offset)
+        appended = decode_qualities(inputfile.read(end - offset))
+    length = max(len(checkpoint[0]), len(appended[0]))
+    totals = [np.pad(totals, (0, length - len(totals))) for totals in (*checkpoint, *appended)]
+    assert_totals((totals[0] + totals[2], totals[1] + totals[3]),
+                  naive_totals([quality for _, quality in records]))
+
+
+def test_checkpoint_of_last_record_without_newline(tmp_path):
+    records = make_records(10, seed=5)
+    path = str(tmp_path / "growing.fastq")
+    data = b"".join(record for record, _ in records)
+    with open(path, 'wb') as outputfile:
+        outputfile.write(data[:-1])
+    end = last_record_end(path, 0)
+    assert end == len(data) - 1
+    store_checkpoint(path, end, decode_qualities(data[:-1]))
+
+    with open(path, 'ab') as outputfile:
+        outputfile.write(b"\n" + records[0][0])
+    offset, _ = load_checkpoint(path)
+    assert offset == len(data)
+    assert last_record_end(path, offset) == len(data) + len(records[0][0])
+
+
+def test_checkpoint_of_replaced_file(tmp_path):
+    records = make_records(10, seed=6)
+    path = str(tmp_path / "replaced.fastq")
+    data = b"".join(record for record, _ in records)
+    with open(path, 'wb') as outputfile:
+        outputfile.write(data)
+    store_checkpoint(path, len(data), decode_qualities(data))
+    with open(path, 'wb') as outputfile:
+        outputfile.write(data.replace(b"@read", b"@READ"))
+    assert load_checkpoint(path) == (0, None)